@@ -2,6 +2,7 @@
 import os
 import inspect
 from .utils.observable import Observable, ODict
+from .utils.cache import DocumentCache, LRUCache
 from . import errors, models as core_models
 from .backends.sqlite import SQLiteDatabase
 
@@ -22,7 +23,6 @@ class Application(ODict):
         if app is None:
             app = self
 
-        self.docs = ODict()
         self.events = ODict()
         self.is_server = is_server
         self.is_client = not self.is_server
@@ -34,7 +34,11 @@ class Application(ODict):
        
     def init_db(self):
         self.db = SQLiteDatabase(self)
+        self.db.on('change', self.on_db_change)
         self.db.connect()
+        if self.db.changes:
+            self.db.changes.setup()
+            self.db.changes.start()
         self.register_meta(core_models.models)
         # TODO: need move below code to `iampy create-project`
         if not self.db.table_exists('DocType') \
@@ -44,6 +48,25 @@ class Application(ODict):
             self.load_all_meta()
             self.db.close()
 
+    def after_fork(self):
+        self.db.after_fork()
+
+        # what the master cached may be stale by now, workers forked on a restart
+        # missed every change since the master started
+        for doctype in self.models:
+            self.clear_meta(doctype)
+        self.docs.clear()
+        self.db.cache.clear(local = True)
+
+        # warm metas and a reader connection before taking traffic
+        for doctype in self.models:
+            self.get_meta(doctype)
+        self.db.acquire(readonly=True)
+        self.db.release()
+
+        if self.db.changes:
+            self.db.changes.start()
+
     def init_config(self):
         # TODO: need removal from app code, and import from `iampy create-project` dir
         self.config = ODict(
@@ -55,9 +78,52 @@ class Application(ODict):
                     'iampy.db'
                 ),
                 connection_params=ODict(),
+                pool=ODict(
+                    max_size = 8,
+                    idle_timeout = 300,
+                    timeout = 30
+                ),
+                pragmas=ODict(
+                    journal_mode = 'wal',
+                    synchronous = 'normal',
+                    cache_size = -64000,
+                    mmap_size = 268435456,
+                    temp_store = 'memory',
+                    busy_timeout = 5000
+                ),
+                # True for ODict rows, 'records' for compact read-only rows
                 dictrows = True,
+                # get_all shapes slower than this (seconds) feed index suggestions
+                slow_query_time = 0.25,
+                # share change events between worker processes on the same file,
+                # requests poll for them, `poll_interval` adds a background poller
+                changes = ODict(
+                    enabled = False,
+                    poll_interval = None,
+                    retention = 600
+                ),
                 debug = False
             ),
+            cache=ODict(
+                docs=ODict(
+                    max_size = 1000,
+                    ttl = 300,
+                    # per doctype ttl in seconds, 0 disables caching the doctype
+                    doctype_ttl = ODict()
+                ),
+                responses=ODict(
+                    max_size = 0,
+                    ttl = 60
+                ),
+                db=ODict(
+                    max_size = 10000,
+                    ttl = 300,
+                    # sqlite file shared by worker processes as a second tier
+                    path = None,
+                    # serve `db.get_value(doctype, name, ...)` from the cache
+                    memoize = False
+                )
+            ),
             web=ODict(
                 static_files_dir=os.path.join(
                     os.path.abspath(os.path.dirname(__file__)),
@@ -76,6 +142,16 @@ class Application(ODict):
         )
 
     def init_globals(self):
+        self.docs = DocumentCache(
+            max_size = self.config.cache.docs.max_size,
+            ttl = self.config.cache.docs.ttl,
+            doctype_ttl = self.config.cache.docs.doctype_ttl
+        )
+        # rendered list responses keyed by ETag, off unless `max_size` is set
+        self.responses = LRUCache(
+            max_size = self.config.cache.responses.max_size,
+            ttl = self.config.cache.responses.ttl
+        ) if self.config.cache.responses.max_size else None
         self.meta_cache = ODict()
         self.models = ODict()
         self.forms = ODict()
@@ -160,6 +236,11 @@ class Application(ODict):
     def load_meta(self, meta):
         self.meta_cache[meta] = self.get_doc('DocType', meta)
 
+    def clear_meta(self, doctype):
+        # the built meta and its field index are rebuilt on next `get_meta`
+        if doctype in self.models:
+            self.meta_cache[doctype] = self.models[doctype]
+
     def get_models(self, filter_fn):
         models = self.models.values()
         return filter(filter_fn, models) if filter_fn else models
@@ -191,39 +272,32 @@ class Application(ODict):
             return response.json()
 
     def add_to_cache(self, doc):
-        if not self.docs:
-            return
+        # only saved documents are cached, as a private copy, and only once the
+        # transaction that wrote or read them committed
+        if doc.doctype and doc.name and not doc._not_inserted:
+            key, copy = (doc.doctype, doc.name), doc.copy()
+            self.db.after_commit(lambda: self.docs.set(key, copy))
 
-        # add to `app.docs` cache
-        if doc.doctype and doc.name:
-            import pdb; pdb.set_trace()
-            if not doc.doctype in self.docs:
-                self.docs[doc.doctype] = ODict()
-            
-            self.docs[doc.doctype][doc.name] = doc
-
-            # Singles available as first level objects too
-            if doc.doctype == doc.name:
-                self.docs[doc.name] = doc
+    def remove_from_cache(self, doctype, name):
+        self.docs.delete((doctype, name))
 
-            # propagate change to `docs`
-            doc.on('change', lambda docs=self.docs, **kwargs: docs.trigger('change', **kwargs))
+    def on_db_change(self, doctype = None, name = None, names = None, **kwargs):
+        if name is None and names is None:
+            self.docs.evict_doctype(doctype)
+            return
 
-    def remove_from_cache(self, doctype, name):
-        if self.docs and doctype in self.docs and name in self.docs[doctype]:
-            del self.docs[doctype][name]
+        for changed in (names or [name]):
+            self.remove_from_cache(doctype, changed)
     
     def is_dirty(self, doctype, name):
-        return self.docs \
-            and doctype in self.docs \
-            and name in self.docs[doctype] \
-            and self.docs[doctype][name]._dirty
+        doc = self.docs.get((doctype, name))
+        return bool(doc and doc._dirty)
 
     def get_doc_from_cache(self, doctype, name):
-        if self.docs \
-            and doctype in self.docs \
-            and name in self.docs[doctype]:
-            return self.docs[doctype][name]
+        # callers get their own copy, mutations never leak into the cache
+        doc = self.docs.get((doctype, name))
+        if doc is not None:
+            return doc.copy()
 
     def get_meta(self, doctype):
         from iampy.model.meta import BaseMeta
@@ -243,12 +317,15 @@ class Application(ODict):
         doc = self.get_doc_from_cache(doctype, name)
 
         if not doc:
+            version = self.db.get_version(doctype)
             doc = self.get_document_class(doctype)(ODict(
                 doctype = doctype,
                 name = name
             ))
             doc.load()
-            self.add_to_cache(doc)
+            # a commit during the load may have evicted before this fill
+            if self.db.get_version(doctype) == version:
+                self.add_to_cache(doc)
         
         return doc
 
@@ -0,0 +1,318 @@
+import json
+import hashlib
+from iampy import errors
+from iampy.backends.query import encode_cursor
+from iampy.utils.observable import ODict
+from iampy.utils import serialize
+from iampy.utils.serialize import prepare
+
+
+# Document operations shared by the web entry points, they run where the
+# database connection lives
+
+
+def load_doc(app, doctype, name):
+    return app.get_doc(doctype, name)
+
+
+def create_doc(app, doctype, data):
+    data.doctype = doctype
+    doc = app.new_doc(data)
+
+    # every field has an entry, failed ones a non-empty list
+    errors = doc.get_errors()
+    if any(errors.values()):
+        return {
+            'status': -1,
+            'msg': errors
+        }
+
+    doc.db_insert()
+    return {
+        'status': 0,
+        'id': doc.name
+    }
+
+
+def update_doc(app, doctype, name, data):
+    doc = app.get_doc(doctype, name)
+    doc.update(data)
+    doc.db_update()
+    return doc
+
+
+def delete_docs(app, doctype, names):
+    for name in names:
+        app.db.delete(doctype, name)
+
+
+# ETags
+#
+# documents and lists are tagged by the change counters of their doctypes, a
+# document by its `modified` too, since `set_value` writes leave that alone,
+# counters are per process, so the epoch is part of the tag
+
+def make_etag(*parts):
+    return '"{}"'.format(hashlib.sha1(json.dumps(parts, default=str).encode()).hexdigest())
+
+
+def get_doc_etag(app, doctype, name):
+    if app.get_meta(doctype).is_single:
+        return None
+
+    versions = get_versions(app, doctype, with_children = True)
+    modified = app.db.get_cached_value(doctype, name, 'modified')
+    if modified is None:
+        return None
+    return make_etag(app.db.epoch, doctype, name, modified, versions)
+
+
+def get_list_etag(app, doctype, params, with_children = False):
+    return make_etag(app.db.epoch, doctype, get_versions(app, doctype, with_children), sorted(params))
+
+
+def get_versions(app, doctype, with_children = False):
+    versions = [app.db.get_version(doctype)]
+    if with_children:
+        versions.extend(
+            app.db.get_version(field.childtype)
+            for field in app.get_meta(doctype).get_children_fields()
+        )
+    return versions
+
+
+def etag_matches(header, etag):
+    if not header or not etag:
+        return False
+    if header.strip() == '*':
+        return True
+    return etag in (tag.strip() for tag in header.split(','))
+
+
+# Lists
+#
+# `/api/resource/<doctype>` for both web entry points, the query string arrives
+# as an ODict and the servers only wrap what comes back
+#
+#   ?fields=["name","title"]&filters={...}&limit=20&order_by=modified&after=<cursor>
+#   ?stream=json|ndjson&chunk_size=500
+
+def get_list_args(query):
+    # `get_all` keywords, `fields` and `filters` are JSON encoded
+    return ODict(
+        fields = load_param(query.fields),
+        filters = load_param(query.filters),
+        offset = int(query.offset or 0),
+        group_by = query.group_by or '',
+        order_by = query.order_by or 'creation',
+        order = query.order or 'asc',
+        after = query.after or None
+    )
+
+
+def load_param(value):
+    if isinstance(value, str):
+        return json.loads(value) if value else None
+    return value
+
+
+def get_list_response(app, doctype, query, if_none_match = None):
+    # ODict(status, body, headers) with the body already rendered
+
+    # answered from the doctype change counters, rows are not read
+    etag = get_list_etag(app, doctype, query.items(), bool(query.with_children))
+    if etag_matches(if_none_match, etag):
+        return ODict(status = 304, body = b'', headers = ODict(ETag = etag))
+    if app.responses is not None:
+        cached = app.responses.get(etag)
+        if cached is not None:
+            return ODict(status = 200, body = cached[0], headers = ODict(cached[1], ETag = etag))
+
+    args = get_list_args(query)
+    limit = int(query.limit or 20)
+
+    # the next cursor needs the sort column of the last row, rows come back
+    # with the fields asked for only
+    extra = [] if args.group_by else get_cursor_fields(args.fields, args.order_by)
+    if extra:
+        args.fields = list(args.fields) + extra
+
+    data = app.db.get_all(doctype, limit = limit, **args)
+
+    headers = ODict()
+    if len(data) == limit and not args.group_by:
+        headers['X-Next-Cursor'] = encode_cursor(data[-1], args.order_by)
+
+    if query.with_children:
+        # one query per child table for the whole page
+        app.db.load_children_many(data, app.get_meta(doctype))
+
+    body = serialize.dumps(drop_fields(data, extra))
+    if app.responses is not None:
+        app.responses.set(etag, (body, ODict(headers)))
+    headers['ETag'] = etag
+    return ODict(status = 200, body = body, headers = headers)
+
+
+def get_cursor_fields(fields, order_by):
+    # columns the next cursor reads that the caller did not ask for
+    if not fields or '*' in fields:
+        return []
+    return [fieldname for fieldname in dict.fromkeys((order_by, 'name')) if fieldname not in fields]
+
+
+def drop_fields(rows, fieldnames):
+    # copies, records are read-only
+    if not fieldnames:
+        return rows
+    return [
+        ODict((key, value) for key, value in row.items() if key not in fieldnames)
+        for row in rows
+    ]
+
+
+def get_stream_args(query):
+    # `iter_chunks` keywords, unlike pages a stream is unlimited by default
+    args = get_list_args(query)
+    args.limit = int(query.limit) if query.limit else None
+    args.chunk_size = int(query.chunk_size or 500)
+    return args
+
+
+def stream_list(app, doctype, query, stream):
+    # rows are written as they are fetched, one chunk per `fetchmany`
+    meta = app.get_meta(doctype)
+
+    yield stream.start()
+    for rows in app.db.iter_chunks(doctype, **get_stream_args(query)):
+        if query.with_children:
+            app.db.load_children_many(rows, meta)
+        yield stream.encode(rows)
+    yield stream.end()
+
+
+class ListStream(object):
+    # a `stream=json` body is one array written chunk by chunk, `ndjson` a row per line
+    def __init__(self, fmt):
+        self.fmt = fmt
+        self.first = True
+        self.content_type = 'application/x-ndjson' if fmt == 'ndjson' else 'application/json'
+
+    def start(self):
+        return b'[' if self.fmt == 'json' else b''
+
+    def encode(self, rows):
+        # rows are dumped straight into the chunk
+        chunk = []
+        write = chunk.append
+        for row in rows:
+            if self.fmt == 'json' and not self.first:
+                write(b',')
+            serialize.dump(row, write)
+            if self.fmt == 'ndjson':
+                write(b'\n')
+            self.first = False
+        return b''.join(chunk)
+
+    def end(self):
+        return b']' if self.fmt == 'json' else b''
+
+
+# Batch operations
+#
+#   {"op": "get", "doctype": "ToDo", "name": "T1"}
+#   {"op": "get_value", "doctype": "ToDo", "name": "T1", "fieldname": "status"}
+#   {"op": "get_list", "doctype": "ToDo", "fields": [...], "filters": {...}, "limit": 20}
+#   {"op": "create", "doctype": "ToDo", "data": {...}}
+#   {"op": "update", "doctype": "ToDo", "name": "T1", "data": {...}}
+#   {"op": "delete", "doctype": "ToDo", "name": "T1"}
+#   {"op": "method", "method": "...", "args": [...], "kwargs": {...}}
+
+def batch_get_list(app, op):
+    return app.db.get_all(
+        doctype = op.doctype,
+        fields = op.fields,
+        filters = op.filters,
+        limit = op.limit or 20,
+        offset = op.offset or 0,
+        order_by = op.order_by or 'creation',
+        order = op.order or 'asc',
+        after = op.after or None
+    )
+
+
+def batch_create(app, op):
+    result = create_doc(app, op.doctype, ODict(op.data or {}))
+    if result['status'] == -1:
+        # a failed create must fail its operation, or atomic batches would commit
+        raise errors.ValidationError(result['msg'])
+    return result
+
+
+BATCH_OPERATIONS = ODict({
+    'get': lambda app, op: load_doc(app, op.doctype, op.name),
+    'get_value': lambda app, op: app.db.get_value(op.doctype, op.name, op.fieldname or 'name'),
+    'get_list': batch_get_list,
+    'create': batch_create,
+    'update': lambda app, op: update_doc(app, op.doctype, op.name, ODict(op.data or {})),
+    'delete': lambda app, op: delete_docs(app, op.doctype, [op.name]),
+    'method': lambda app, op: app(op.method, *(op.args or ()), **(op.kwargs or {}))
+})
+
+
+def get_error_result(e):
+    if isinstance(e, errors.BaseError):
+        return ODict(status = e.status_code, error = e.name, message = e.args[0] if e.args else '')
+    return ODict(status = 500, error = type(e).__name__, message = str(e))
+
+
+def run_batch(app, operations, atomic = False):
+    # every operation runs in its own savepoint of one transaction, a failed one
+    # is undone alone, or with the whole batch when `atomic`
+    db = app.db
+    results = []
+    failed = False
+
+    # caches are only filled and versions only moved after the commit, a rolled
+    # back savepoint drops its share of that work
+    db.savepoint('batch')
+    try:
+        for i, op in enumerate(operations):
+            op = ODict(op)
+
+            if failed:
+                results.append(ODict(status = 424, error = 'FailedDependency', message = 'Not run, an earlier operation failed'))
+                continue
+
+            handler = BATCH_OPERATIONS.get(op.op)
+            if handler is None:
+                results.append(ODict(status = 400, error = 'BadRequest', message = f'Unknown operation: {op.op}'))
+                failed = atomic
+                continue
+
+            db.savepoint(f'batch_{i}')
+            try:
+                data = handler(app, op)
+            except Exception as e:
+                db.rollback_to_savepoint(f'batch_{i}')
+                results.append(get_error_result(e))
+                failed = atomic
+            else:
+                db.release_savepoint(f'batch_{i}')
+                # documents nested in the results are not seen by the encoder
+                results.append(ODict(status = 200, data = prepare(data)))
+
+        if failed:
+            db.rollback_to_savepoint('batch')
+        else:
+            # commits, unless the batch runs inside a wider transaction
+            db.release_savepoint('batch')
+    except Exception:
+        db.rollback_to_savepoint('batch')
+        raise
+
+    return ODict(
+        atomic = bool(atomic),
+        committed = not failed,
+        results = results
+    )
@@ -0,0 +1,274 @@
+import os
+import re
+import json
+import sqlite3
+from urllib.parse import parse_qsl
+
+from iampy import get_application, errors
+from iampy.api import load_doc, create_doc, update_doc, delete_docs, run_batch, \
+    get_doc_etag, etag_matches, get_list_response, get_stream_args, ListStream
+from iampy.backends.aio import AsyncDatabase
+from iampy.utils.observable import ODict
+from iampy.utils import serialize
+
+
+# Raw ASGI 3 application serving the `/api/resource` and `/api/method` routes of
+# `iampy.web` on top of `AsyncDatabase`, keep-alive and pipelining are left to the
+# server, eg:
+#
+#   WEB_CONCURRENCY=4 uvicorn iampy.asgi:application
+#   hypercorn iampy.asgi:application
+#
+# the server does not tell its workers how many siblings they have, the change bus
+# keeping their caches in sync is only enabled when `workers` (or `WEB_CONCURRENCY`,
+# which uvicorn also reads as its worker count) is above 1
+
+
+class Request(object):
+    __slots__ = ('method', 'path', 'query', 'headers', 'body')
+
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.query = ODict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+        self.headers = ODict(
+            (key.decode('latin-1'), value.decode('latin-1'))
+            for key, value in scope.get('headers', ())
+        )
+        self.body = body
+
+    def json(self, default = None):
+        if not self.body:
+            return default
+        return json.loads(self.body, object_pairs_hook=ODict)
+
+
+class Response(object):
+    __slots__ = ('status', 'body', 'headers', 'stream')
+
+    def __init__(self, body = None, status = 200, headers = None, stream = None):
+        self.status = status
+        self.body = body
+        self.headers = ODict(headers or {})
+        self.stream = stream
+
+
+class ASGIApplication(object):
+    def __init__(self, app = None, readers = 4, workers = None):
+        self.app = app
+        self.readers = readers
+        self.workers = workers or int(os.environ.get('WEB_CONCURRENCY', 0)) or None
+        self.db = None
+        self.routes = []
+
+        self.add_route('GET', '/api/resource/<doctype>', self.get_list)
+        self.add_route('GET', '/api/resource/<doctype>/<name>', self.get_doc)
+        self.add_route('GET', '/api/resource/<doctype>/<name>/<fieldname>', self.get_value)
+        self.add_route('POST', '/api/resource/<doctype>/search', self.search)
+        self.add_route('POST', '/api/resource/<doctype>', self.create)
+        self.add_route('PUT', '/api/resource/<doctype>/<name>', self.update)
+        self.add_route('DELETE', '/api/resource/<doctype>/<name>', self.delete_one)
+        self.add_route('DELETE', '/api/resource/<doctype>', self.delete_many)
+        self.add_route('POST', '/api/method/<method>', self.call_method)
+        self.add_route('POST', '/api/batch', self.batch)
+
+    def add_route(self, method, rule, handler):
+        pattern = re.sub(r'<(\w+)>', r'(?P<\1>[^/]+)', rule)
+        self.routes.append((method, re.compile(f'^{pattern}$'), handler))
+
+    def match(self, method, path):
+        allowed = False
+        for route_method, pattern, handler in self.routes:
+            match = pattern.match(path)
+            if match:
+                if route_method == method:
+                    return handler, match.groupdict()
+                allowed = True
+        return (405 if allowed else 404), None
+
+    def setup(self):
+        if self.app is None:
+            self.app = get_application()
+        if self.db is None:
+            if self.workers and self.workers > 1:
+                self.app.db.enable_changes()
+            self.db = AsyncDatabase(self.app.db, readers=self.readers)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        self.setup()
+        body = await self.read_body(receive)
+        request = Request(scope, body)
+
+        handler, params = self.match(request.method, request.path)
+        if params is None:
+            response = Response({'error': 'Not Found' if handler == 404 else 'Method Not Allowed'}, handler)
+        else:
+            response = await self.dispatch(handler, request, params)
+
+        await self.send(send, response)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.setup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.db:
+                    self.db.close(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_body(self, receive):
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    async def dispatch(self, handler, request, params):
+        if self.app.db.changes:
+            # evict what sibling workers changed since the last request
+            self.app.db.changes.poll()
+
+        try:
+            rv = await handler(request, **params)
+        except errors.BaseError as e:
+            return Response({'error': e.name, 'message': str(e)}, e.status_code)
+        except sqlite3.IntegrityError as e:
+            return Response({'error': 'Database Error', 'message': str(e)}, 500)
+
+        if isinstance(rv, Response):
+            return rv
+        return Response(rv)
+
+    async def send(self, send, response):
+        headers = response.headers
+        headers.setdefault('content-type', 'application/json')
+        headers.setdefault('cache-control', 'no-cache')
+
+        if response.status == 304:
+            body = b''
+            headers.pop('content-type')
+        elif response.stream is None:
+            # bytes are an already rendered body
+            body = response.body
+            if not isinstance(body, bytes):
+                body = serialize.dumps(body)
+            headers['content-length'] = str(len(body))
+
+        await send({
+            'type': 'http.response.start',
+            'status': response.status,
+            'headers': [(key.encode('latin-1'), str(value).encode('latin-1')) for key, value in headers.items()]
+        })
+
+        if response.stream is None:
+            await send({'type': 'http.response.body', 'body': body})
+            return
+
+        # chunks go out as they are fetched, the connection is kept for the next request
+        async for chunk in response.stream:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def get_list(self, request, doctype):
+        query = request.query
+        if query.stream in ('json', 'ndjson'):
+            return self.stream_list(request, doctype)
+
+        # read and rendered on a reader, identical requests in flight share it
+        rv = await self.db.read(self.get_list_response, doctype, query, request.headers['if-none-match'])
+        headers = ODict((key.lower(), value) for key, value in rv.headers.items())
+        return Response(rv.body, rv.status, headers=headers)
+
+    def get_list_response(self, doctype, query, if_none_match):
+        return get_list_response(self.app, doctype, query, if_none_match)
+
+    def stream_list(self, request, doctype):
+        query = request.query
+        stream = ListStream(query.stream)
+        meta = self.app.get_meta(doctype)
+
+        prepare = None
+        if query.with_children:
+            prepare = lambda rows: self.app.db.load_children_many(rows, meta)
+
+        async def body():
+            yield stream.start()
+            async for rows in self.db.iter_chunks(doctype, prepare = prepare, **get_stream_args(query)):
+                yield stream.encode(rows)
+            yield stream.end()
+
+        return Response(stream = body(), headers = {'content-type': stream.content_type})
+
+    async def get_doc(self, request, doctype, name):
+        etag = await self.db.call(get_doc_etag, self.app, doctype, name)
+        if etag_matches(request.headers['if-none-match'], etag):
+            return Response(status=304, headers={'etag': etag})
+
+        data = await self.db.call(load_doc, self.app, doctype, name)
+        return Response(data, headers={'etag': etag} if etag else None)
+
+    async def get_value(self, request, doctype, name, fieldname):
+        return ODict(**{name: await self.db.get_value(doctype, name, fieldname)})
+
+    async def search(self, request, doctype):
+        data = request.json(ODict())
+        return await self.db.read(
+            self.app.db.search,
+            doctype,
+            data.query or '',
+            fields = data.fields,
+            filters = data.filters,
+            limit = data.limit or 20,
+            offset = data.offset or 0
+        )
+
+    async def create(self, request, doctype):
+        return await self.db.write(create_doc, self.app, doctype, request.json(ODict()))
+
+    async def update(self, request, doctype, name):
+        return await self.db.write(update_doc, self.app, doctype, name, request.json(ODict()))
+
+    async def delete_one(self, request, doctype, name):
+        await self.db.delete(doctype, name)
+        return {}
+
+    async def delete_many(self, request, doctype):
+        await self.db.write(delete_docs, self.app, doctype, request.json([]))
+        return {}
+
+    async def call_method(self, request, method):
+        data = request.json(ODict())
+        return await self.db.write(self.app, method, *(data.args or ()), **(data.kwargs or {}))
+
+    async def batch(self, request):
+        data = request.json(ODict())
+        if isinstance(data, list):
+            data = ODict(operations = data)
+        return await self.db.write(run_batch, self.app, data.operations or [], data.atomic)
+
+
+application = ASGIApplication()
+
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        import asyncio
+        from hypercorn.config import Config
+        from hypercorn.asyncio import serve
+
+        config = Config()
+        config.bind = ['127.0.0.1:8080']
+        asyncio.run(serve(application, config))
+    else:
+        uvicorn.run(application, host='127.0.0.1', port=8080)
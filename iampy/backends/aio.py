@@ -0,0 +1,151 @@
+import json
+import asyncio
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncDatabase(object):
+    # asyncio facade over a `Database`
+    #
+    # every executor has a single thread, so each one works on its own thread-local
+    # connection: one writer (SQLite allows a single writer) and `readers` readers
+    # borrowing read-only connections, reads never queue behind writes
+    def __init__(self, db, readers = 4):
+        self.db = db
+        self.writer = ThreadPoolExecutor(1, thread_name_prefix='iampy-db-writer')
+        self.readers = [
+            ThreadPoolExecutor(1, thread_name_prefix=f'iampy-db-reader-{i}')
+            for i in range(readers)
+        ]
+        self.next_reader = itertools.cycle(self.readers)
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def run(self, readonly, fn, *args, **kwargs):
+        # runs on the executor thread
+        self.db.acquire(readonly=readonly)
+        try:
+            result = fn(*args, **kwargs)
+            if not readonly:
+                self.db.commit()
+            return result
+        except Exception:
+            if not readonly and self.db.in_transaction():
+                self.db.rollback()
+            raise
+        finally:
+            self.db.release()
+
+    async def read(self, fn, *args, **kwargs):
+        # identical reads in flight share one query, each caller gets its own rows
+        key = json.dumps([fn.__name__, args, kwargs], sort_keys=True, default=str)
+        loop = asyncio.get_running_loop()
+
+        with self.lock:
+            future = self.inflight.get(key)
+            if future is None:
+                future = loop.run_in_executor(
+                    next(self.next_reader),
+                    lambda: self.run(True, fn, *args, **kwargs)
+                )
+                self.inflight[key] = future
+                future.add_done_callback(lambda f, key=key: self.forget(key, f))
+
+        return copy_result(await asyncio.shield(future))
+
+    async def call(self, fn, *args, **kwargs):
+        # an uncoalesced read, for callers working through documents
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            next(self.next_reader),
+            lambda: self.run(True, fn, *args, **kwargs)
+        )
+
+    async def write(self, fn, *args, **kwargs):
+        # reads started before the write must not be joined after it
+        with self.lock:
+            self.inflight.clear()
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.writer,
+            lambda: self.run(False, fn, *args, **kwargs)
+        )
+
+    def forget(self, key, future):
+        with self.lock:
+            if self.inflight.get(key) is future:
+                del self.inflight[key]
+
+    async def get_all(self, doctype, **kwargs):
+        return await self.read(self.db.get_all, doctype, **kwargs)
+
+    async def get_doc(self, doctype, name = None, fields = '*'):
+        return await self.read(self.db.get_doc, doctype, name, fields)
+
+    async def get_value(self, doctype, filters, fieldname = 'name'):
+        return await self.read(self.db.get_value, doctype, filters, fieldname)
+
+    async def exists(self, doctype, name):
+        return await self.read(self.db.exists, doctype, name)
+
+    async def iter_chunks(self, doctype, prepare = None, **kwargs):
+        # the cursor stays on one reader thread, and its connection, until exhausted
+        loop = asyncio.get_running_loop()
+        reader = next(self.next_reader)
+        chunks = self.db.iter_chunks(doctype, **kwargs)
+
+        def fetch():
+            rows = next(chunks, None)
+            if rows is not None and prepare:
+                prepare(rows)
+            return rows
+
+        await loop.run_in_executor(reader, lambda: self.db.acquire(readonly=True))
+        try:
+            while True:
+                rows = await loop.run_in_executor(reader, fetch)
+                if rows is None:
+                    break
+                yield rows
+        finally:
+            await loop.run_in_executor(reader, chunks.close)
+            await loop.run_in_executor(reader, self.db.release)
+
+    async def insert(self, doctype, doc):
+        return await self.write(self.db.insert, doctype, doc)
+
+    async def update(self, doctype, doc, changed = None):
+        return await self.write(self.db.update, doctype, doc, changed)
+
+    async def delete(self, doctype, name):
+        return await self.write(self.db.delete, doctype, name)
+
+    async def sql(self, query, params = (), readonly = False):
+        # rows are fetched on the executor, cursors never leave its thread
+        if readonly:
+            return await self.read(self.fetch_all, query, params)
+        return await self.write(self.fetch_all, query, params)
+
+    def fetch_all(self, query, params = ()):
+        return self.db.sql(query, params).fetchall()
+
+    async def transaction(self, fn, *args, **kwargs):
+        # `fn(db, ...)` runs on the writer and commits once, or rolls back as a whole
+        return await self.write(fn, self.db, *args, **kwargs)
+
+    def close(self, wait = True):
+        self.writer.shutdown(wait=wait)
+        for reader in self.readers:
+            reader.shutdown(wait=wait)
+
+
+def copy_result(result):
+    # dicts and lists are copied all the way down, child tables included, so a
+    # caller mutating its rows leaves the others alone
+    if isinstance(result, dict):
+        return type(result)((key, copy_result(value)) for key, value in result.items())
+    if isinstance(result, list):
+        return [copy_result(value) for value in result]
+    return result
@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+
+
+class ChangeBus(object):
+    # `trigger_change` events shared between processes writing the same file
+    #
+    # every change is appended to the `_changes` table in the writer's transaction,
+    # siblings notice new commits through `PRAGMA data_version` and replay the rows
+    # written by other processes, so only the affected keys are evicted
+    #
+    # rows older than `retention` are pruned, the highest pruned id is kept as a
+    # low-water mark, a process that had not read up to it missed evictions and
+    # drops everything it cached
+    table = '_changes'
+    pruned_table = '_changes_pruned'
+
+    def __init__(self, db, poll_interval = None, retention = 600):
+        self.db = db
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        self.reset()
+
+    def reset(self):
+        # called again in a forked child, which must not share the parent's state
+        self.origin = uuid.uuid4().hex
+        self.pid = os.getpid()
+        self.conn = None
+        self.data_version = None
+        self.last_id = None
+        self.published = 0
+        self.thread = None
+
+    def setup(self):
+        # on a connection of its own, the thread may hold none, eg. in the master
+        # of a pre-fork server, or in a server thread the app was not built on
+        conn = sqlite3.connect(self.db.app.config.db.file, isolation_level = None)
+        try:
+            conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.table} ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT NOT NULL, '
+                'doctype TEXT NOT NULL, name TEXT, names TEXT, created REAL NOT NULL)'
+            )
+            conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.pruned_table} ('
+                'id INTEGER PRIMARY KEY CHECK (id = 1), pruned INTEGER NOT NULL)'
+            )
+        finally:
+            conn.close()
+
+    def get_connection(self):
+        if self.pid != os.getpid():
+            self.reset()
+
+        if self.conn is None:
+            self.conn = sqlite3.connect(
+                self.db.app.config.db.file,
+                check_same_thread = False,
+                isolation_level = None
+            )
+            self.last_id = max(
+                self.conn.execute(f'SELECT max(id) FROM {self.table}').fetchone()[0] or 0,
+                self.get_pruned()
+            )
+            self.data_version = self.get_data_version()
+        return self.conn
+
+    def get_pruned(self):
+        row = self.conn.execute(f'SELECT pruned FROM {self.pruned_table} WHERE id = 1').fetchone()
+        return row[0] if row else 0
+
+    def get_data_version(self):
+        # changes only when another connection commits to the file
+        return self.conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def publish(self, doctype, name, names = None):
+        if self.pid != os.getpid():
+            self.reset()
+
+        # ride the caller's transaction, a rollback drops the event with the data
+        pending = self.db.in_transaction()
+        self.db.run(
+            f'INSERT INTO {self.table} (origin, doctype, name, names, created) VALUES (?, ?, ?, ?, ?)',
+            (self.origin, doctype, name, json.dumps(names) if names is not None else None, time.time())
+        )
+
+        self.published += 1
+        if self.published % 256 == 0:
+            self.prune()
+
+        if not pending:
+            self.db.commit()
+
+    def prune(self):
+        # in the caller's transaction, the mark moves with the deleted rows
+        pruned = self.db.sql_tuples(
+            f'SELECT max(id) FROM {self.table} WHERE created < ?', (time.time() - self.retention,)
+        ).fetchone()[0]
+        if pruned is not None:
+            self.db.run(f'DELETE FROM {self.table} WHERE id <= ?', (pruned,))
+            self.db.run(
+                f'INSERT OR REPLACE INTO {self.pruned_table} (id, pruned) VALUES (1, ?)', (pruned,)
+            )
+
+    def poll(self):
+        with self.lock:
+            conn = self.get_connection()
+            data_version = self.get_data_version()
+            if data_version == self.data_version:
+                return 0
+            self.data_version = data_version
+
+            # read in one snapshot, rows pruned after the mark was read are still there
+            conn.execute('BEGIN')
+            try:
+                pruned = self.get_pruned()
+                missed = pruned > self.last_id
+                rows = conn.execute(
+                    f'SELECT id, origin, doctype, name, names FROM {self.table} WHERE id > ? ORDER BY id',
+                    (self.last_id,)
+                ).fetchall()
+            finally:
+                conn.execute('COMMIT')
+            self.last_id = rows[-1][0] if rows else max(self.last_id, pruned)
+
+        if missed:
+            self.db.evict_all()
+            return len(rows)
+
+        count = 0
+        for id, origin, doctype, name, names in rows:
+            if origin == self.origin:
+                continue
+            self.db.trigger_change(
+                doctype, name, json.loads(names) if names is not None else None, publish = False
+            )
+            count += 1
+        return count
+
+    def start(self):
+        # optional background polling, for processes not driven by requests
+        if not self.poll_interval or (self.thread and self.pid == os.getpid()):
+            return
+
+        def run():
+            while True:
+                time.sleep(self.poll_interval)
+                try:
+                    self.poll()
+                except Exception:
+                    pass
+
+        self.thread = threading.Thread(target=run, name='iampy-changes', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
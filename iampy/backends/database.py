@@ -1,20 +1,88 @@
-import json
+import time
+import uuid
+import inspect
+import datetime
+import threading
 from iampy.utils.observable import Observable, ODict
-from iampy.utils.cache import CacheManager
+from iampy.utils.cache import CacheManager, DiskStore, MISSING
+from .indexes import IndexManager
+from .changes import ChangeBus
+from .query import QueryPlan, QueryPlanCache, get_filter_shape, get_where_clause, decode_cursor
 from iampy.utils import get_random_string
 from iampy import errors
 
 
 class Database(Observable):
+    # keeps batched `IN (...)` queries under the bound parameters limit
+    max_variables = 900
+
     def __init__(self, app):
         super().__init__()
         self.app = app
         self.init_type_map()
-        self.cache = CacheManager()
+        # route `get_value` by name through the value cache
+        self.memoize_values = False
+        self.cache = self.init_cache()
+        self.changes = self.init_changes()
+        # per doctype change counters, only comparable within one `epoch`
+        self.versions = {}
+        self.epoch = uuid.uuid4().hex
+        self.query_plans = QueryPlanCache()
+        self.indexes = IndexManager(self)
+        self.local = threading.local()
+        self.pool = None
+        self.read_pool = None
+        self.fts5 = None
+
+    def init_cache(self):
+        config = self.app.config.cache and self.app.config.cache.db
+        if not config:
+            return CacheManager()
+
+        self.memoize_values = bool(config.memoize)
+        return CacheManager(
+            max_size = config.max_size,
+            ttl = config.ttl,
+            store = DiskStore(config.path) if config.path else None
+        )
+
+    def init_changes(self):
+        config = self.app.config.db.changes
+        if not config or not config.enabled or self.app.config.db.file == ':memory:':
+            return None
+
+        return ChangeBus(
+            self,
+            poll_interval = config.poll_interval,
+            retention = config.retention or 600
+        )
+
+    def enable_changes(self):
+        # without the change bus, caches in sibling workers go stale
+        if not self.changes:
+            self.app.config.db.changes.enabled = True
+            self.changes = self.init_changes()
+            if self.changes:
+                self.changes.setup()
 
     def close(self):
         self.conn and self.conn.close()
 
+    def after_fork(self):
+        # connections opened before a fork belong to the parent, drop them unused
+        self.local = threading.local()
+        self.pool = None
+        self.read_pool = None
+        self.epoch = uuid.uuid4().hex
+        if self.changes:
+            self.changes.reset()
+
+    def acquire(self, readonly = False):
+        self.connect()
+
+    def release(self):
+        self.close()
+
     def migrate(self):
         for doctype in self.app.models:
             meta = self.app.get_meta(doctype)
@@ -24,6 +92,10 @@ class Database(Observable):
                     self.alter_table(base_doctype)
                 else:
                     self.create_table(base_doctype)
+                self.indexes.reconcile(base_doctype)
+                if not meta.is_child:
+                    self.create_search_index(base_doctype)
+        self.query_plans.clear()
         self.commit()
 
     def create_table(self, doctype, new_name = None):
@@ -43,6 +115,30 @@ class Database(Observable):
     def table_exists(self, table):
         pass
 
+    def create_indexes(self, doctype, indexes):
+        pass
+
+    def drop_index(self, name):
+        pass
+
+    def get_table_indexes(self, doctype):
+        return []
+
+    def create_search_index(self, doctype):
+        pass
+
+    def search(self, doctype, text, fields = None, filters = None, limit = 20, offset = 0):
+        # backends without a full-text index fall back to scanning the keywords
+        filters = dict(filters or {})
+        filters['keywords'] = ['like', text]
+        return self.get_all(
+            doctype = doctype,
+            fields = fields,
+            filters = filters,
+            limit = limit,
+            offset = offset
+        )
+
     def run_create_table_query(self, doctype, table_def):
         pass
 
@@ -68,7 +164,7 @@ class Database(Observable):
 
         table_columns = self.get_table_columns(doctype)
         valid_fields = self.app.get_meta(doctype).get_valid_fields(with_children=False)
-        valid_field_names = map(lambda df: df.fieldname, valid_fields)
+        valid_field_names = tuple(map(lambda df: df.fieldname, valid_fields))
         diff = ODict(added=[], removed=[])
 
         for field in valid_fields:
@@ -84,7 +180,7 @@ class Database(Observable):
 
     def add_columns(self, doctype, added):
         for column in added:
-            self.run_add_column_query(doctype, field)
+            self.run_add_column_query(doctype, column)
 
     def remove_columns(self, doctype, removed):
         for column in removed:
@@ -130,28 +226,73 @@ class Database(Observable):
         if not doc:
             return
 
-        self.load_children(doc, meta)
-        return doc
+        return self.load_children(doc, meta)
+
+    def get_docs(self, doctype, names, fields='*'):
+        meta = self.app.get_meta(doctype)
+        docs = ODict()
+
+        for chunk in self.chunk(list(names)):
+            for doc in self.get_all(
+                    doctype = doctype,
+                    fields = fields,
+                    filters = {'name': ['in', chunk]},
+                    order_by = None):
+                docs[doc.name] = doc
+
+        docs = [docs[name] for name in names if name in docs]
+        self.load_children_many(docs, meta)
+        return docs
 
     def load_children(self, doc, meta):
-        table_fields = meta.get_table_fields()
-        form_fields = meta.get_form_fields()
-
-        for field in table_fields:
-            doc[field.fieldname] = self.get_all(
-                doctype = field.childtype,
-                fields = ['*'],
-                filters = {'parent': doc.name},
-                order_by = 'idx',
-                order = 'asc'
-            )
-        
-        for field in form_fields:
-            doc[field.fieldname] = self.get_one(
-                doctype = field.childtype,
-                fields = ['*'],
-                filters = {'parent': doc.name},
-            )
+        return self.load_children_many([doc], meta)[0]
+
+    def load_children_many(self, docs, meta):
+        parents = [doc.name for doc in docs]
+        if not parents:
+            return docs
+
+        if meta.get_children_fields():
+            # read-only rows become dicts before their children are attached
+            docs[:] = map(self.as_dict, docs)
+
+        for field in meta.get_table_fields():
+            children = self.get_children(field.childtype, parents, field.fieldname)
+            for doc in docs:
+                doc[field.fieldname] = list(map(self.as_dict, children.get(doc.name, [])))
+
+        for field in meta.get_form_fields():
+            children = self.get_children(field.childtype, parents, field.fieldname)
+            for doc in docs:
+                rows = children.get(doc.name)
+                doc[field.fieldname] = self.as_dict(rows[0]) if rows else None
+
+        return docs
+
+    def get_children(self, childtype, parents, parentfield):
+        # one `parent IN (...)` query per chunk of parents, grouped by parent
+        children = {}
+
+        for chunk in self.chunk(parents):
+            for row in self.get_all(
+                    doctype = childtype,
+                    fields = ['*'],
+                    filters = {
+                        'parent': ['in', chunk],
+                        'parentfield': parentfield
+                    },
+                    order_by = 'parent, idx',
+                    order = 'asc'):
+                children.setdefault(row.parent, []).append(row)
+
+        return children
+
+    def as_dict(self, row):
+        return row if isinstance(row, dict) else ODict(row)
+
+    def chunk(self, values):
+        for i in range(0, len(values), self.max_variables):
+            yield values[i:i + self.max_variables]
         
     def get_single(self, doctype):
         return ODict(
@@ -172,12 +313,59 @@ class Database(Observable):
     def prepare_fields(self, fields):
         return ", ".join(fields)
 
-    def trigger_change(self, doctype, name):
-        self.trigger(f'change:{doctype}', name=name)
-        self.trigger('change', doctype=doctype, name=name)
+    def trigger_change(self, doctype, name, names=None, publish=True):
+        # `names` is set instead of `name` when a whole batch changed at once
+        if publish and self.changes:
+            # let sibling processes evict the same keys, in the same transaction
+            self.changes.publish(doctype, name, names)
+
+        # caches are evicted now, so the transaction reads its own writes, and
+        # again once the rows are visible to everyone, dropping what readers
+        # cached from the old rows meanwhile; versions only move then
+        self.evict_change(doctype, name, names)
+        self.after_commit(lambda: self.commit_change(doctype, name, names))
+
+    def evict_change(self, doctype, name, names = None):
+        if doctype == 'DocType':
+            # compiled plans and field indexes depend on the re-saved meta
+            for meta_name in (names or [name]):
+                self.query_plans.clear(meta_name)
+                self.app.clear_meta(meta_name)
+
+        if name is None and names is None:
+            self.cache.hclear_prefix(f'{doctype}:')
+        else:
+            for changed in (names if names is not None else [name]):
+                self.clear_value_cache(doctype, changed)
+
+        self.trigger(f'change:{doctype}', name=name, names=names)
+        self.trigger('change', doctype=doctype, name=name, names=names)
+        meta = self.app.get_meta(doctype)
+        if meta.based_on:
+            self.evict_change(meta.based_on, name, names)
+
+    def commit_change(self, doctype, name, names = None):
+        # the version first, a reader that started before it does not cache
+        self.versions[doctype] = self.versions.get(doctype, 0) + 1
         meta = self.app.get_meta(doctype)
         if meta.based_on:
-            self.trigger.change(meta.based_on, name)
+            self.versions[meta.based_on] = self.versions.get(meta.based_on, 0) + 1
+
+        self.evict_change(doctype, name, names)
+
+    def evict_all(self):
+        # changes were missed, nothing this process cached can be trusted, the
+        # shared disk tier was evicted by the writers themselves
+        self.query_plans.clear()
+        self.cache.clear(local = True)
+        for doctype in list(self.app.models):
+            self.versions[doctype] = self.versions.get(doctype, 0) + 1
+            self.app.clear_meta(doctype)
+            self.trigger(f'change:{doctype}', name=None, names=None)
+            self.trigger('change', doctype=doctype, name=None, names=None)
+
+    def get_version(self, doctype):
+        return self.versions.get(doctype, 0)
 
     def insert(self, doctype, doc):
         meta = self.app.get_meta(doctype)
@@ -200,6 +388,87 @@ class Database(Observable):
     def insert_one(self, doctype, doc):
         pass
 
+    def insert_many(self, doctype, docs):
+        for doc in docs:
+            self.insert_one(doctype, doc)
+
+    def bulk_insert(self, doctype, docs, batch_size = 500):
+        meta = self.app.get_meta(doctype)
+
+        if meta.is_single:
+            raise errors.ValueError(f'Cannot bulk insert into Single DocType {doctype}')
+
+        count = 0
+        batch = []
+
+        for doc in docs:
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                count += self.insert_batch(doctype, batch)
+                batch = []
+
+        if batch:
+            count += self.insert_batch(doctype, batch)
+
+        return count
+
+    def insert_batch(self, doctype, docs):
+        meta = self.app.get_meta(doctype)
+        base_doctype = meta.get_base_doctype()
+
+        # group parent and child rows per table
+        tables = ODict({base_doctype: []})
+
+        for doc in docs:
+            doc = self.prepare_insert(doctype, doc)
+            doc = self.apply_base_doctype_filters(doctype, doc)
+            tables[base_doctype].append(doc)
+
+            for field in meta.get_table_fields():
+                for idx, child in enumerate(doc[field.fieldname] or [], 1):
+                    self.prepare_child(base_doctype, doc.name, child, field, idx)
+                    tables.setdefault(field.childtype, []).append(child)
+
+            for field in meta.get_form_fields():
+                child = doc[field.fieldname]
+                if child:
+                    self.prepare_child(base_doctype, doc.name, child, field, 1)
+                    tables.setdefault(field.childtype, []).append(child)
+
+        # a transaction opened by the caller is left for the caller to end
+        owned = not self.in_transaction()
+        if owned:
+            self.begin()
+
+        try:
+            for table, rows in tables.items():
+                self.insert_many(table, rows)
+            self.trigger_change(doctype, None, names=[doc.name for doc in tables[base_doctype]])
+        except Exception:
+            if owned:
+                self.rollback()
+            raise
+
+        if owned:
+            self.commit()
+
+        return len(tables[base_doctype])
+
+    def prepare_insert(self, doctype, data):
+        # named, defaulted and stamped like `BaseDocument.db_insert`, without
+        # the insert events
+        from iampy.model.document import BaseDocument
+
+        if isinstance(data, BaseDocument):
+            doc = data
+        else:
+            doc = self.app.new_doc(ODict(data, doctype = doctype))
+
+        doc.set_name()
+        doc.set_standard_values()
+        doc.commit()
+        return doc.get_valid_dict()
+
     def insert_children(self, meta, doc, doctype):
         # table fields
         for field in meta.get_table_fields():
@@ -213,7 +482,7 @@ class Database(Observable):
             self.prepare_child(doctype, doc.name, child, field, 1)
             self.insert_one(field.childtype, child)
 
-    def update(self, doctype, doc):
+    def update(self, doctype, doc, changed = None):
         meta = self.app.get_meta(doctype)
         base_doctype = meta.get_base_doctype()
 
@@ -223,7 +492,7 @@ class Database(Observable):
         if meta.is_single:
             self.update_single(meta, doc, doctype)
         else:
-            self.update_one(base_doctype, doc)
+            self.update_one(base_doctype, doc, changed)
 
         # insert or update children
         self.update_children(meta, doc, base_doctype)
@@ -235,35 +504,62 @@ class Database(Observable):
     
     def update_children(self, meta, doc, doctype):
         for field in meta.get_table_fields():
-            added = []
-
-            for child in (doc[field.fieldname] or []):
-                self.prepare_child(doctype, doc.name, child, field, len(added))
-                if self.exists(field.childtype, child.name):
-                    self.update_one(field.childtype, child)
-                else:
-                    self.insert_one(field.childtype, child)
-                added.append(child.name)
-            
-            self.run_delete_other_children(field, doc.name, added)
+            children = doc[field.fieldname] or []
+            for idx, child in enumerate(children, 1):
+                self.prepare_child(doctype, doc.name, child, field, idx)
+            self.sync_children(field, doc.name, children)
 
         for field in meta.get_form_fields():
-            child = doc[field.fieldname] or ODict()
-            self.prepare_child(doctype, doc.name, child, field, 1)
-            if self.exists(field.childtype, child.name):
-                self.update_one(field.childtype, child)
-            else:
-                self.insert_one(field.childtype, child)
-            self.run_delete_other_children(field, doc.name, [child.name])
+            children = []
+            child = doc[field.fieldname]
+            if child:
+                self.prepare_child(doctype, doc.name, child, field, 1)
+                children.append(child)
+            self.sync_children(field, doc.name, children)
+
+    def sync_children(self, field, parent, children):
+        # diff against the stored rows instead of an exists() round trip per row
+        fields = self.get_keys(field.childtype)
+        stored_rows = self.get_children(field.childtype, [parent], field.fieldname)
+        stored = {row.name: row for row in stored_rows.get(parent, [])}
+
+        # updated rows grouped by the set of columns that actually changed
+        inserted, updated = [], ODict()
+        for child in children:
+            row = stored.pop(child.name, None)
+            if row is None:
+                inserted.append(child)
+                continue
+
+            changed = tuple(df.fieldname for df in self.get_changed_fields(fields, child, row))
+            if changed:
+                updated.setdefault(changed, []).append(child)
+
+        if inserted:
+            self.insert_many(field.childtype, inserted)
+        for changed, rows in updated.items():
+            self.update_many(field.childtype, rows, changed)
+        if stored:
+            self.delete_rows(field.childtype, list(stored))
+
+    def get_changed_fields(self, fields, doc, row):
+        return [
+            field for field in fields
+            if self.get_formatted_value(field, doc[field.fieldname]) != row[field.fieldname]
+        ]
 
-    def update_one(self, doctype, doc):
+    def update_one(self, doctype, doc, changed = None):
         pass
         #valid_fields = self.get_valid_fields(doctype)
         #fields_to_update = filter(lambda f: f != 'name', doc.keys())
         #fields = filter(lambda df, u=fields_to_update, field.fieldname in u, valid_fields)
         #formatted_doc = self.get_formatted_doc(fields, doc)
 
-    def run_delete_other_children(self, field, parent, added):
+    def update_many(self, doctype, docs, changed = None):
+        for doc in docs:
+            self.update_one(doctype, doc, changed)
+
+    def delete_rows(self, doctype, names):
         pass
 
     def update_single(self, doctype, doc):
@@ -285,7 +581,7 @@ class Database(Observable):
         pass
 
     def rename(self, doctype, old_name, new_name):
-        pass
+        self.trigger_change(doctype, old_name)
 
     def prepare_child(self, parenttype, parent, child, field, idx):
         if not child.name:
@@ -299,6 +595,13 @@ class Database(Observable):
     def get_keys(self, doctype):
         return self.app.get_meta(doctype).get_valid_fields(with_children = False)
 
+    def get_update_keys(self, doctype, changed = None):
+        # columns written by an UPDATE, only the changed ones when known
+        return [
+            df for df in self.get_keys(doctype)
+            if df.fieldname != 'name' and (changed is None or df.fieldname in changed)
+        ]
+
     def get_valid_fields(self, doctype):
         return self.app.get_meta(doctype).get_valid_fields(with_children = False)
     
@@ -315,9 +618,6 @@ class Database(Observable):
         ]
 
     def get_formatted_value(self, field, value):
-        import datetime
-        import inspect
-        
         if field.fieldtype == "Tags":
             return ",".join((value or []))
         elif (field.fieldtype == "Code" and field.options == 'Python') or callable(value):
@@ -350,6 +650,8 @@ class Database(Observable):
         for field in meta.get_form_fields():
             self.delete_children(field.childtype, name)
 
+        self.trigger_change(doctype, name)
+
     def delete_one(self, doctype, name):
         pass
 
@@ -359,9 +661,14 @@ class Database(Observable):
     def exists(self, doctype, name):
         return bool(self.get_value(doctype, name))
 
-    def get_value(self, doctype, filters, fieldname='name'):
+    def get_value(self, doctype, filters, fieldname='name', cache=None):
         meta = self.app.get_meta(doctype)
         base_doctype = meta.get_base_doctype()
+
+        if cache is None:
+            cache = self.memoize_values
+        if cache and isinstance(filters, str) and not meta.filters:
+            return self.get_cached_value(doctype, filters, fieldname)
         
         if isinstance(filters, str):
             filters = {'name': filters}
@@ -385,14 +692,27 @@ class Database(Observable):
         })
 
     def set_values(self, doctype, name, values):
-        doc = values.copy()
+        doc = ODict(values)
         doc['name'] = name
-        return self.update_one(doctype, doc)
+        result = self.update_one(
+            self.app.get_meta(doctype).get_base_doctype(), doc, set(values)
+        )
+        self.trigger_change(doctype, name)
+        return result
 
     def get_cached_value(self, doctype, name, fieldname):
-        value = self.cache.hget(f'{doctype}:{name}', fieldname)
-        if value is None:
-            value = self.get_value(doctype, name, fieldname)
+        # missing rows are cached as None too, inserts clear them
+        key = f'{doctype}:{name}'
+        value = self.cache.hget(key, fieldname, MISSING)
+        if value is MISSING:
+            version = self.get_version(doctype)
+            since = time.time()
+            value = self.get_value(doctype, name, fieldname, cache=False)
+            # a read inside a transaction may never commit, and a commit that moved
+            # the version meanwhile evicts before or after this `hset`, the disk
+            # tier drops the fill if any worker evicted the key since the read
+            if not self.in_transaction() and self.get_version(doctype) == version:
+                self.cache.hset(key, fieldname, value, since = since)
         return value
 
     def get_all(self,
@@ -403,41 +723,132 @@ class Database(Observable):
                 offset = None,
                 group_by = None,
                 order_by = 'creation',
-                order = 'desc'):
-        
+                order = 'desc',
+                after = None):
+
+        plan, params = self.get_all_plan(doctype, fields, filters, limit, offset, group_by, order_by, order, after)
+
+        start = time.perf_counter()
+        rows = self.sql(plan.sql, params).fetchall()
+        self.indexes.observe(plan, time.perf_counter() - start)
+
+        return rows
+
+    def iter_all(self, *args, chunk_size = 500, **kwargs):
+        # same arguments as `get_all`, rows are yielded as they are fetched
+        for rows in self.iter_chunks(*args, chunk_size=chunk_size, **kwargs):
+            yield from rows
+
+    def iter_chunks(self,
+                doctype, 
+                fields = None,
+                filters = None,
+                limit = None,
+                offset = None,
+                group_by = None,
+                order_by = 'creation',
+                order = 'desc',
+                after = None,
+                chunk_size = 500):
+
+        query, params = self.get_all_query(doctype, fields, filters, limit, offset, group_by, order_by, order, after)
+        cursor = self.sql(query, params)
+
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+    def get_all_query(self, doctype, fields, filters, limit, offset, group_by, order_by, order, after = None):
+        plan, params = self.get_all_plan(doctype, fields, filters, limit, offset, group_by, order_by, order, after)
+        return plan.sql, params
+
+    def get_all_plan(self, doctype, fields, filters, limit, offset, group_by, order_by, order, after = None):
+        # an empty `fields` (eg. a missing query param) means the keyword fields
+        if not fields:
+            fields = None
+        elif isinstance(fields, str):
+            fields = [fields]
+
+        if after:
+            # keyset pagination replaces the offset
+            after = decode_cursor(after)
+            offset = None
+
+        shape, args = get_filter_shape(filters)
+        key = (
+            doctype,
+            tuple(fields) if fields else None,
+            shape,
+            group_by or None,
+            order_by or None,
+            order,
+            bool(limit),
+            bool(limit and offset),
+            bool(after)
+        )
+
+        plan = self.query_plans.get(key)
+        if plan is None:
+            plan = self.compile_get_all(*key)
+            plan.key = key
+            self.query_plans.set(key, plan)
+
+        return plan, plan.bind(args, limit, offset, after)
+
+    def compile_get_all(self, doctype, fields, shape, group_by, order_by, order, limit, offset, after = False):
         meta = self.app.get_meta(doctype)
         base_doctype = meta.get_base_doctype()
 
         if not fields:
             fields = meta.get_keyword_fields()
-        elif isinstance(fields, str):
-            fields = [fields]
 
-        if 'name' not in fields:
+        fields = list(fields)
+        if 'name' not in fields and '*' not in fields:
             fields.insert(0, 'name')
 
-        fields = ", ".join(fields)
+        # filters forced by the base doctype are bound after the request ones
+        meta_shape, meta_args = get_filter_shape(meta.filters)
 
-        if meta.filters:
-            filters.update(meta.filters)
+        sql = f'SELECT {", ".join(fields)} FROM {base_doctype}'
+        where = get_where_clause(shape + meta_shape)
+
+        # `name` breaks ties so keyset pages never skip or repeat rows
+        tie_breaker = order_by and order_by != 'name' and not group_by \
+            and order_by.isidentifier()
+
+        after_values = 0
+        if after:
+            if order_by == 'name':
+                predicate, after_values = 'name {} ?', 1
+            elif tie_breaker:
+                predicate, after_values = f'({order_by}, name) {{}} (?, ?)', 2
+            else:
+                raise errors.ValueError(f'Cannot paginate with a cursor on "{order_by}"')
 
-        sql = f'SELECT {fields} FROM {base_doctype} '
-        where, args = self.get_filter_conditions(filters)
+            predicate = predicate.format('<' if (order or '').lower() == 'desc' else '>')
+            where += f' AND {predicate}' if where else f' WHERE {predicate}'
 
         sql += where
 
-        if order_by:
-            sql += f' ORDER BY {order_by} {order}'
-        
         if group_by:
             sql += f' GROUP BY {group_by}'
 
+        if order_by:
+            sql += f' ORDER BY {order_by} {order}'
+            if tie_breaker:
+                sql += f', name {order}'
+
         if limit:
-            sql += f' LIMIT {limit}'
+            sql += ' LIMIT ?'
             if offset:
-                sql += f' OFFSET {offset}'
+                sql += ' OFFSET ?'
 
-        return self.sql(sql, args).fetchall()
+        return QueryPlan(sql, meta_args, limit, offset, after_values)
 
     def get_filter_conditions(self, filters):
         # {"status": "Open"} => `status = "Open"`
@@ -448,51 +859,8 @@ class Database(Observable):
         #
         # {"date": ["between", ["2017-09-09", "2017-11-01"]} => `date between "2017-09-09" and date <= "2017-11-01"`
 
-        args, where_list = [], []
-        where = lambda args: " ".join(args)
-
-        if isinstance(filters, str):
-            filters = json.loads(filters or '{}')
-
-        if not filters:
-            filters = {}
-
-        for field, value in filters.items(): 
-            operator = '='
-            comparison_value = value
-
-            if isinstance(value, list):
-                while value :
-                    if len(value) > 2:
-                        operator, comparison_value = value.pop(0), value.pop(1)
-                        placeholder = "?"
-                        operator = operator.lower()
-
-                        if isinstance(comparison_value, list):
-                            if operator == "between":
-                                placeholder = '? and ?'
-                            else: # in operator
-                                placeholder = '({})'.format(','.join("?" * len(value)))
-                        
-                        if operator == 'like' and '%' not in comparison_value:
-                            comparison_value = "%{}%".format(comparison_value)
-
-                        where_list.append(where([field, operator, placeholder]))
-                        if not isinstance(comparison_value, list):
-                            args.append(comparison_value)
-                        else:
-                            args.extend(comparison_value)
-                    else:
-                        where_list.append(where([field, "=", "?"]))
-                        args.append(value.pop(0))
-
-            else:
-                where_list.append(where([field, operator, "?"]))
-                args.append(value)
-
-        if where_list:
-            return " WHERE {}".format(" AND ".join(where_list)), args
-        return "", []
+        shape, args = get_filter_shape(filters)
+        return get_where_clause(shape), args
 
     def run(self, query, params = ()):
         return self.sql(query, params)
@@ -503,6 +871,61 @@ class Database(Observable):
     def begin(self):
         self.sql('begin transaction;')
 
+    def in_transaction(self):
+        return False
+
+    def after_commit(self, fn):
+        # `fn` runs once the current transaction commits, and never if it rolls back
+        if self.in_transaction():
+            self.local.__dict__.setdefault('after_commit', []).append(fn)
+        else:
+            fn()
+
+    def run_after_commit(self):
+        self.local.__dict__.pop('savepoints', None)
+        for fn in self.local.__dict__.pop('after_commit', None) or ():
+            fn()
+
+    def discard_after_commit(self, since = 0):
+        pending = self.local.__dict__.get('after_commit')
+        if pending:
+            del pending[since:]
+        if not since:
+            self.local.__dict__.pop('savepoints', None)
+
+    def savepoint(self, name):
+        # starts a transaction when none is open, releasing it then commits
+        savepoints = self.local.__dict__.setdefault('savepoints', [])
+        pending = self.local.__dict__.get('after_commit') or ()
+        savepoints.append((name, len(pending), not self.in_transaction()))
+        self.sql(f'SAVEPOINT {name}')
+
+    def pop_savepoint(self, name):
+        savepoints = self.local.__dict__.get('savepoints') or []
+        while savepoints:
+            savepoint = savepoints.pop()
+            if savepoint[0] == name:
+                return savepoint
+        return (name, 0, False)
+
+    def release_savepoint(self, name):
+        self.sql(f'RELEASE SAVEPOINT {name}')
+        name, since, started = self.pop_savepoint(name)
+        if started:
+            self.run_after_commit()
+
+    def rollback_to_savepoint(self, name):
+        self.sql(f'ROLLBACK TO SAVEPOINT {name}')
+        self.sql(f'RELEASE SAVEPOINT {name}')
+        name, since, started = self.pop_savepoint(name)
+        self.discard_after_commit(since)
+
+    def rollback(self):
+        try:
+            self.sql('rollback;')
+        finally:
+            self.discard_after_commit()
+
     def commit(self):
         try:
             self.sql('commit;')
@@ -513,6 +936,7 @@ class Database(Observable):
                 pass
             else:
                 raise e
+        self.run_after_commit()
     
     def clear_value_cache(self, doctype, name):
         key = ":".join([doctype, name])
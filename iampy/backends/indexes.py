@@ -0,0 +1,123 @@
+import threading
+from iampy.utils.observable import ODict
+
+
+class IndexManager(object):
+    # indexes named with this prefix are owned by the manager and may be dropped
+    prefix = 'idx_'
+
+    def __init__(self, db):
+        self.db = db
+        self.slow_queries = ODict()
+        self.lock = threading.Lock()
+
+    def get_index_name(self, doctype, fields):
+        return f'{self.prefix}{doctype}_{"_".join(fields)}'
+
+    def get_standard_indexes(self, meta):
+        if meta.is_child:
+            # `load_children` reads rows per parent and field, ordered by idx
+            return [ODict(fields = ['parent', 'parentfield', 'idx'])]
+
+        # default `order_by` and keyset pagination seek on (order_by, name)
+        return [
+            ODict(fields = ['creation', 'name']),
+            ODict(fields = ['modified', 'name'])
+        ]
+
+    def get_declared_indexes(self, meta):
+        return [
+            ODict(fields = [field.fieldname], unique = field.unique)
+            for field in meta.get_valid_fields(with_children = False)
+            if (field.indexed or field.unique) and field.fieldname != 'name'
+        ]
+
+    def get_indexes(self, meta):
+        indexes = ODict()
+        doctype = meta.get_base_doctype()
+
+        for index in self.get_standard_indexes(meta) + self.get_declared_indexes(meta):
+            index.name = self.get_index_name(doctype, index.fields)
+            indexes[index.name] = index
+
+        return list(indexes.values())
+
+    def reconcile(self, doctype):
+        meta = self.db.app.get_meta(doctype)
+        base_doctype = meta.get_base_doctype()
+
+        desired = self.get_indexes(meta)
+        existing = {
+            index.name: index for index in self.db.get_table_indexes(base_doctype)
+            if index.name.startswith(self.prefix)
+        }
+
+        self.db.create_indexes(base_doctype, [
+            index for index in desired if index.name not in existing
+        ])
+
+        desired_names = [index.name for index in desired]
+        for name in existing:
+            if name not in desired_names:
+                self.db.drop_index(name)
+
+    def observe(self, plan, elapsed):
+        threshold = self.db.app.config.db.slow_query_time
+        if threshold is None or elapsed < threshold:
+            return
+
+        with self.lock:
+            entry = self.slow_queries.get(plan.key)
+            if entry is None:
+                entry = self.slow_queries[plan.key] = ODict(count = 0, elapsed = 0.0, sql = plan.sql)
+            entry.count += 1
+            entry.elapsed += elapsed
+
+    def get_suggestions(self, min_count = 1):
+        # advisory only: equality columns first, then one range or the sort column
+        suggestions = ODict()
+
+        for key, entry in list(self.slow_queries.items()):
+            doctype, fields, shape, group_by, order_by = key[:5]
+            if entry.count < min_count:
+                continue
+
+            columns = []
+            for fieldname, operator, count in shape:
+                if operator in ('=', 'in', 'is') and fieldname not in columns:
+                    columns.append(fieldname)
+
+            ranges = [
+                fieldname for fieldname, operator, count in shape
+                if operator in ('<', '<=', '>', '>=', 'between') and fieldname not in columns
+            ]
+            if ranges:
+                columns.append(ranges[0])
+            elif order_by and order_by.isidentifier() and order_by not in columns:
+                columns.append(order_by)
+
+            if not columns or self.is_covered(doctype, columns):
+                continue
+
+            name = self.get_index_name(doctype, columns)
+            suggestion = suggestions.get(name)
+            if suggestion is None:
+                suggestion = suggestions[name] = ODict(
+                    doctype = doctype,
+                    fields = columns,
+                    count = 0,
+                    elapsed = 0.0,
+                    queries = []
+                )
+            suggestion.count += entry.count
+            suggestion.elapsed += entry.elapsed
+            suggestion.queries.append(entry.sql)
+
+        return sorted(suggestions.values(), key=lambda s: s.elapsed, reverse=True)
+
+    def is_covered(self, doctype, columns):
+        base_doctype = self.db.app.get_meta(doctype).get_base_doctype()
+        for index in self.db.get_table_indexes(base_doctype):
+            if list(index.fields[:len(columns)]) == columns:
+                return True
+        return False
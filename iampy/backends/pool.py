@@ -0,0 +1,115 @@
+import time
+import threading
+from collections import deque
+from iampy import errors
+
+
+class ConnectionPool(object):
+    def __init__(self, factory, max_size = 8, idle_timeout = 300, timeout = 30, check = None):
+        self.factory = factory
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.check = check
+        self.size = 0
+        self.idle = deque()
+        self.local = threading.local()
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        # a thread gets back the connection it already holds
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            self.local.depth += 1
+            return conn
+
+        conn = self.checkout()
+        self.local.conn = conn
+        self.local.depth = 1
+        return conn
+
+    def release(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            return
+
+        self.local.depth -= 1
+        if self.local.depth > 0:
+            return
+
+        self.local.conn = None
+        self.checkin(conn)
+
+    def checkout(self):
+        deadline = time.monotonic() + self.timeout
+
+        with self.condition:
+            while True:
+                self.prune()
+
+                # most recently used first, keeps the warmest connections busy
+                while self.idle:
+                    conn, released = self.idle.pop()
+                    if self.is_healthy(conn):
+                        return conn
+                    self.discard(conn)
+
+                if self.size < self.max_size:
+                    self.size += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise errors.DatabaseError('Timed out waiting for a database connection')
+                self.condition.wait(remaining)
+
+        try:
+            return self.factory()
+        except Exception:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+
+    def checkin(self, conn):
+        with self.condition:
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+            except Exception:
+                self.discard(conn)
+            else:
+                self.idle.append((conn, time.monotonic()))
+            self.condition.notify()
+
+    def is_healthy(self, conn):
+        try:
+            if self.check:
+                return self.check(conn)
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except Exception:
+            return False
+
+    def prune(self):
+        if not self.idle_timeout:
+            return
+
+        expired = time.monotonic() - self.idle_timeout
+        while self.idle and self.idle[0][1] < expired:
+            conn, released = self.idle.popleft()
+            self.discard(conn)
+
+    def discard(self, conn):
+        self.size -= 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        with self.condition:
+            while self.idle:
+                conn, released = self.idle.popleft()
+                self.discard(conn)
+            self.condition.notify_all()
@@ -0,0 +1,162 @@
+import json
+import base64
+import threading
+from collections import OrderedDict
+from iampy.utils.observable import ODict
+from iampy import errors
+
+
+OPERATORS = (
+    '=', '!=', '<>', '<', '<=', '>', '>=',
+    'like', 'not like', 'in', 'not in', 'between', 'is'
+)
+
+
+def get_filter_shape(filters):
+    # Split filters into a hashable shape and the values to bind
+    #
+    # {"status": "Open"} => (("status", "=", 1),), ["Open"]
+    #
+    # {"name": ["like", "apple%"]} => (("name", "like", 1),), ["apple%"]
+    #
+    # {"date": [">=", "2017-09-09", "<=", "2017-11-01"]} => (("date", ">=", 1), ("date", "<=", 1)), [...]
+    #
+    # {"date": ["between", ["2017-09-09", "2017-11-01"]]} => (("date", "between", 2),), [...]
+    #
+    # {"status": ["in", ["Open", "Closed"]]} => (("status", "in", 2),), ["Open", "Closed"]
+
+    shape, args = [], []
+
+    if isinstance(filters, str):
+        filters = json.loads(filters or '{}')
+
+    def add(field, operator, value):
+        if operator in ('between', 'in', 'not in') and isinstance(value, (list, tuple)):
+            shape.append((field, operator, len(value)))
+            args.extend(value)
+            return
+
+        if operator in ('like', 'not like') and isinstance(value, str) and '%' not in value:
+            value = f'%{value}%'
+
+        shape.append((field, operator, 1))
+        args.append(value)
+
+    for field, value in (filters or {}).items():
+        if not isinstance(value, (list, tuple)):
+            add(field, '=', value)
+            continue
+
+        value = list(value)
+        while value:
+            if len(value) > 1 \
+                    and isinstance(value[0], str) \
+                    and value[0].lower() in OPERATORS:
+                operator = value.pop(0).lower()
+                add(field, operator, value.pop(0))
+            else:
+                add(field, '=', value.pop(0))
+
+    return tuple(shape), args
+
+
+def get_where_clause(shape):
+    where_list = []
+
+    for field, operator, count in shape:
+        if operator == 'between':
+            placeholder = '? AND ?'
+        elif operator in ('in', 'not in'):
+            placeholder = '({})'.format(','.join('?' * count))
+        else:
+            placeholder = '?'
+        where_list.append(f'{field} {operator} {placeholder}')
+
+    if where_list:
+        return ' WHERE {}'.format(' AND '.join(where_list))
+    return ''
+
+
+def encode_cursor(row, order_by = 'creation'):
+    # opaque `after` token holding the (order_by, name) of the last row of a page
+    value = [row[order_by], row['name']]
+    return base64.urlsafe_b64encode(json.dumps(value, default=str).encode()).decode()
+
+
+def decode_cursor(token):
+    try:
+        value = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except Exception:
+        raise errors.ValueError(f'Invalid pagination cursor: {token}')
+
+    if not isinstance(value, list) or len(value) != 2:
+        raise errors.ValueError(f'Invalid pagination cursor: {token}')
+    return value
+
+
+class QueryPlan(object):
+    __slots__ = ('sql', 'args', 'limit', 'offset', 'after', 'key')
+
+    def __init__(self, sql, args = (), limit = False, offset = False, after = 0, key = None):
+        self.key = key
+        self.sql = sql
+        self.args = tuple(args)
+        self.limit = limit
+        self.offset = offset
+        self.after = after
+
+    def bind(self, args, limit = None, offset = None, after = None):
+        params = list(args)
+        params.extend(self.args)
+        if self.after:
+            # a single value when paging by name itself
+            params.extend(after[-self.after:])
+        if self.limit:
+            params.append(int(limit))
+            if self.offset:
+                params.append(int(offset))
+        return params
+
+
+class QueryPlanCache(object):
+    def __init__(self, max_size = 512):
+        self.max_size = max_size
+        self.plans = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            plan = self.plans.get(key)
+            if plan is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.plans.move_to_end(key)
+            return plan
+
+    def set(self, key, plan):
+        with self.lock:
+            self.plans[key] = plan
+            self.plans.move_to_end(key)
+            while len(self.plans) > self.max_size:
+                self.plans.popitem(last=False)
+
+    def clear(self, doctype = None):
+        with self.lock:
+            if doctype is None:
+                self.plans.clear()
+                return
+
+            for key in [key for key in self.plans if key[0] == doctype]:
+                del self.plans[key]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return ODict(
+            hits = self.hits,
+            misses = self.misses,
+            size = len(self.plans),
+            hit_rate = self.hits / total if total else 0.0
+        )
@@ -1,47 +1,222 @@
+import os
+import re
 import sqlite3
+from urllib.request import pathname2url
 from collections import namedtuple
 from .database import Database, ODict, get_random_string
+from .pool import ConnectionPool
+from .query import get_filter_shape, get_where_clause
 
 def Row(cursor, row):
     return ODict(list(zip(
         [col[0] for col in cursor.description],
         row
     )))
-    
+
+
+class Record(object):
+    # compact read-only row, values live in a tuple and column positions in the class
+    __slots__ = ('_values',)
+    _columns = ()
+    _index = {}
+
+    def __init__(self, values):
+        self._values = values
+
+    def __getattr__(self, name):
+        if name in self._index:
+            return self._values[self._index[name]]
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return None
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            index = self._index.get(key)
+            return None if index is None else self._values[index]
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        raise TypeError('Record is read-only, use as_dict() to get a mutable copy')
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return self._columns == other._columns and self._values == other._values
+        return self.as_dict() == other
+
+    def __repr__(self):
+        return f'Record({self.as_dict()!r})'
+
+    def get(self, key, default=None):
+        index = self._index.get(key)
+        return default if index is None else self._values[index]
+
+    def keys(self):
+        return self._columns
+
+    def values(self):
+        return self._values
+
+    def items(self):
+        return zip(self._columns, self._values)
+
+    def as_dict(self):
+        return ODict(zip(self._columns, self._values))
+
+
+class RecordFactory(object):
+    # row_factory building Records, column names are resolved once per cursor description
+    def __init__(self):
+        self.description = None
+        self.record_class = None
+        self.classes = {}
+
+    def __call__(self, cursor, row):
+        description = cursor.description
+        if description is not self.description:
+            columns = tuple(col[0] for col in description)
+            record_class = self.classes.get(columns)
+            if record_class is None:
+                record_class = self.classes[columns] = type('Record', (Record,), {
+                    '__slots__': (),
+                    '_columns': columns,
+                    '_index': {column: i for i, column in enumerate(columns)}
+                })
+            self.description = description
+            self.record_class = record_class
+        return self.record_class(row)
+
+
 class SQLiteDatabase(Database):
 
+    @property
+    def conn(self):
+        return getattr(self.local, 'conn', None)
+
     def connect(self):
+        self.local.conn = self.open_connection()
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.local.conn = None
+        # an uncommitted transaction went with the connection
+        self.discard_after_commit()
+
+    def acquire(self, readonly = False):
+        # borrow a configured connection from the pool, or connect if pooling is off
+        if not self.app.config.db.pool:
+            return self.connect()
+
+        pools = self.local.__dict__.setdefault('pools', [])
+
+        # a thread already holding the writer keeps using it for reads too
+        if pools and (readonly or pools[-1] is self.pool):
+            pool = pools[-1]
+        else:
+            pool = self.get_pool(readonly)
+
+        conn = pool.acquire()
+        if not pools:
+            # the thread's own connection, and its pending hooks, are back on release
+            self.local.outer = (self.conn, len(self.local.__dict__.get('after_commit') or ()))
+        self.local.conn = conn
+        pools.append(pool)
+
+    def release(self):
+        pools = self.local.__dict__.get('pools')
+        if not pools:
+            return self.close()
+
+        pools.pop().release()
+        if pools:
+            self.local.conn = getattr(pools[-1].local, 'conn', None)
+        else:
+            # the pool rolls back what was left uncommitted
+            self.local.conn, since = self.local.__dict__.pop('outer')
+            self.discard_after_commit(since)
+
+    def get_pool(self, readonly = False):
+        pool_config = self.app.config.db.pool
+
+        if readonly and self.app.config.db.file != ':memory:':
+            if self.read_pool is None:
+                self.read_pool = ConnectionPool(
+                    lambda: self.open_connection(readonly=True, check_same_thread=False),
+                    max_size = pool_config.max_size or 8,
+                    idle_timeout = pool_config.idle_timeout or 0,
+                    timeout = pool_config.timeout or 30
+                )
+            return self.read_pool
+
+        if self.pool is None:
+            # SQLite allows a single writer at a time
+            self.pool = ConnectionPool(
+                lambda: self.open_connection(check_same_thread=False),
+                max_size = 1,
+                idle_timeout = pool_config.idle_timeout or 0,
+                timeout = pool_config.timeout or 30
+            )
+        return self.pool
+
+    def open_connection(self, readonly = False, **params):
         dictrows = self.app.config.db.dictrows 
         text_factory = self.app.config.db.text_factory or str
         functions = self.app.config.db.functions or {}
         aggregates = self.app.config.db.aggregates or {}
         collations = self.app.config.db.collations or {}
         extensions = self.app.config.db.extensions or ()
+        pragmas = ODict(self.app.config.db.pragmas or {})
+        database = self.app.config.db.file
+
+        params.update(self.app.config.db.connection_params or {})
+
+        if readonly:
+            database = 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(database)))
+            params['uri'] = True
+            # the journal mode is persistent and can only be set by the writer
+            pragmas.pop('journal_mode', None)
 
-        self.conn = sqlite3.connect(self.app.config.db.file, **self.app.config.db.connection_params)
-        self.conn.text_factory = text_factory
+        conn = sqlite3.connect(database, **params)
+        conn.text_factory = text_factory
 
-        if dictrows:
-            self.conn.row_factory = Row
+        if dictrows == 'records':
+            conn.row_factory = RecordFactory()
+        elif dictrows:
+            conn.row_factory = Row
 
         for name, value in functions.items():
-            self.conn.create_function(name, *value)
+            conn.create_function(name, *value)
         for name, value in aggregates.items():
-            self.conn.create_aggregate(name, *value)
-        for name in collations.items():
-            self.conn.create_collation(name, value)
+            conn.create_aggregate(name, *value)
+        for name, value in collations.items():
+            conn.create_collation(name, value)
         for name in extensions:
-            self.conn.enable_load_extension(True)
-            self.conn.execute('SELECT load_extension(?)', (name,))
-            self.conn.enable_load_extension(False)
+            conn.enable_load_extension(True)
+            conn.execute('SELECT load_extension(?)', (name,))
+            conn.enable_load_extension(False)
         
-        self.run('PRAGMA foreign_keys=ON')
+        conn.execute('PRAGMA foreign_keys=ON')
+
+        for name, value in pragmas.items():
+            conn.execute(f'PRAGMA {name}={value}')
 
         if self.app.config.db.debug:
-            self.conn.set_trace_callback(print)
+            conn.set_trace_callback(print)
+
+        return conn
 
     def table_exists(self, table):
-        res = self.sql('SELECT count(name) as [exists] FROM sqlite_master WHERE name=? AND type=?', (
+        res = self.sql_tuples('SELECT count(name) as [exists] FROM sqlite_master WHERE name=? AND type=?', (
             table, 'table'
         )).fetchone()
         return bool(res[0])
@@ -74,7 +249,7 @@ class SQLiteDatabase(Database):
         self.commit()
         self.enable_foreign_keys()
 
-    def remove_columns(self):
+    def remove_columns(self, doctype, removed):
         # TODO: need new version of sqlite
         pass
 
@@ -86,10 +261,102 @@ class SQLiteDatabase(Database):
 
         self.run(query)
 
-        for index in (table_def.indexes or []):
+        self.create_indexes(doctype, table_def.indexes)
+
+    def create_indexes(self, doctype, indexes):
+        for index in (indexes or []):
+            fields = index.fields or [index.field]
             unique = 'UNIQUE ' if index.unique else ''
-            query = f"CREATE {unique}INDEX idx_{doctype}_{field} ON {doctype}({field});"
-            self.run(query)
+            name = index.name or f'idx_{doctype}_{"_".join(fields)}'
+            columns = ", ".join(fields)
+            self.run(f'CREATE {unique}INDEX IF NOT EXISTS {name} ON {doctype}({columns});')
+
+    def drop_index(self, name):
+        self.run(f'DROP INDEX IF EXISTS {name}')
+
+    def get_table_indexes(self, doctype):
+        indexes = []
+        for index in self.sql(f'PRAGMA index_list({doctype})').fetchall():
+            columns = self.sql(f'PRAGMA index_info({index["name"]})').fetchall()
+            indexes.append(ODict(
+                name = index['name'],
+                unique = bool(index['unique']),
+                origin = index['origin'],
+                fields = [col['name'] for col in sorted(columns, key=lambda col: col['seqno'])]
+            ))
+        return indexes
+
+    def has_fts5(self):
+        if self.fts5 is None:
+            options = [row[0] for row in self.sql_tuples('PRAGMA compile_options').fetchall()]
+            self.fts5 = 'ENABLE_FTS5' in options
+        return self.fts5
+
+    def create_search_index(self, doctype):
+        # FTS5 shadow table over `keywords`, kept in sync by triggers on the base table
+        if not self.has_fts5():
+            return
+
+        search_table = f'{doctype}_search'
+        exists = self.table_exists(search_table)
+
+        self.run(f"""CREATE VIRTUAL TABLE IF NOT EXISTS {search_table}
+            USING fts5(keywords, content='{doctype}', content_rowid='rowid')""")
+        self.run(f"""CREATE TRIGGER IF NOT EXISTS {search_table}_insert AFTER INSERT ON {doctype} BEGIN
+            INSERT INTO {search_table}(rowid, keywords) VALUES (new.rowid, new.keywords);
+        END""")
+        self.run(f"""CREATE TRIGGER IF NOT EXISTS {search_table}_delete AFTER DELETE ON {doctype} BEGIN
+            INSERT INTO {search_table}({search_table}, rowid, keywords) VALUES ('delete', old.rowid, old.keywords);
+        END""")
+        self.run(f"""CREATE TRIGGER IF NOT EXISTS {search_table}_update AFTER UPDATE OF keywords ON {doctype} BEGIN
+            INSERT INTO {search_table}({search_table}, rowid, keywords) VALUES ('delete', old.rowid, old.keywords);
+            INSERT INTO {search_table}(rowid, keywords) VALUES (new.rowid, new.keywords);
+        END""")
+
+        if not exists:
+            # index the rows written before the search table existed
+            self.rebuild_search_index(doctype)
+
+    def rebuild_search_index(self, doctype):
+        # also needed after a VACUUM, which may renumber the rowids
+        search_table = f'{doctype}_search'
+        self.run(f"INSERT INTO {search_table}({search_table}) VALUES ('rebuild')")
+
+    def search(self, doctype, text, fields = None, filters = None, limit = 20, offset = 0):
+        meta = self.app.get_meta(doctype)
+        base_doctype = meta.get_base_doctype()
+        search_table = f'{base_doctype}_search'
+
+        if not self.has_fts5() or not self.table_exists(search_table):
+            return super().search(doctype, text, fields, filters, limit, offset)
+
+        # every word is matched as a prefix, FTS5 syntax in the input is ignored
+        words = re.findall(r'\w+', text or '')
+        if not words:
+            return []
+        expression = ' '.join(f'"{word}"*' for word in words)
+
+        if not fields:
+            fields = meta.get_keyword_fields()
+        elif isinstance(fields, str):
+            fields = [fields]
+        fields = list(fields)
+        if 'name' not in fields and '*' not in fields:
+            fields.insert(0, 'name')
+        columns = ', '.join(f'doc.{fieldname}' for fieldname in fields)
+
+        filters = dict(filters or {})
+        filters.update(meta.filters or {})
+        shape, args = get_filter_shape(filters)
+        shape = tuple((f'doc.{fieldname}', operator, count) for fieldname, operator, count in shape)
+        where = get_where_clause(shape).replace(' WHERE ', ' AND ', 1)
+
+        query = f"""SELECT {columns}, {search_table}.rank AS score
+            FROM {search_table} JOIN {base_doctype} doc ON doc.rowid = {search_table}.rowid
+            WHERE {search_table} MATCH ?{where}
+            ORDER BY {search_table}.rank LIMIT ? OFFSET ?"""
+
+        return self.sql(query, [expression] + args + [int(limit), int(offset or 0)]).fetchall()
 
     def update_column_definition(self, field, table_def):
         table_def.columns.append(self.get_column_definition(field))
@@ -101,10 +368,10 @@ class SQLiteDatabase(Database):
                 self.get_foreign_key_definition(meta.get_base_doctype(), field)
             )
         
-        if field.indexed or field.unique:
+        if (field.indexed or field.unique) and field.fieldname != 'name':
             table_def.indexes.append(ODict(
                 unique = field.unique,
-                field = field.fieldname
+                fields = [field.fieldname]
             ))
 
     def get_column_definition(self, field):
@@ -131,9 +398,9 @@ class SQLiteDatabase(Database):
     def get_foreign_keys(self, doctype):
         return list(map(lambda d: d['from'], self.sql(f'PRAGMA foreign_key_list({doctype})')))
 
-    def run_add_column_query(self, doctype, field, values):
+    def run_add_column_query(self, doctype, field):
         col_def = self.get_column_definition(field)
-        self.run(f'ALTER TABLE {doctype} ADD COLUMN {col_def}', values)
+        self.run(f'ALTER TABLE {doctype} ADD COLUMN {col_def}')
 
     def get_one(self, doctype, name, fields='*'):
         meta = self.app.get_meta(doctype)
@@ -145,33 +412,61 @@ class SQLiteDatabase(Database):
 
 
     def insert_one(self, doctype, doc):
-        fields = self.get_keys(doctype)
-        placeholders = ','.join(['?'] * len(fields))
-        columns = ','.join([df.fieldname for df in fields])
+        meta = self.app.get_meta(doctype)
+        fields = meta.get_valid_fields(with_children = False)
 
         if not doc.name:
             doc.name = get_random_string()
 
-        return self.run(
-            f"INSERT INTO {doctype} ({columns}) VALUES ({placeholders})",
-            self.get_formatted_values(fields, doc)
+        return self.run(meta.get_insert_query(), self.get_formatted_values(fields, doc))
+
+    def insert_many(self, doctype, docs):
+        meta = self.app.get_meta(doctype)
+        fields = meta.get_valid_fields(with_children = False)
+
+        for doc in docs:
+            if not doc.name:
+                doc.name = get_random_string()
+
+        return self.conn.executemany(
+            meta.get_insert_query(),
+            [self.get_formatted_values(fields, doc) for doc in docs]
         )
 
-    def update_one(self, doctype, doc):
-        fields = self.get_keys(doctype)
-        assigns = ", ".join(map(lambda f: f'{f.fieldname} = ?'))
+    def update_one(self, doctype, doc, changed = None):
+        fields = self.get_update_keys(doctype, changed)
+        if not fields:
+            return
+
         values = self.get_formatted_values(fields, doc)
 
         # additional name for where clause
         values.append(doc.name)
 
-        return self.run(f'UPDATE {doctype} SET {assigns} WHERE name = ?',  values)
+        return self.run(self.get_update_query(doctype, fields), values)
+
+    def update_many(self, doctype, docs, changed = None):
+        fields = self.get_update_keys(doctype, changed)
+        if not fields:
+            return
 
-    def run_delete_other_children(self, field, parent, added):
-        # delete other children
-        added.append(parent)
-        placeholders = ' '.join(['?'] * len(added) - 1)
-        return self.run(f'DELETE FROM {field.childtype} WHERE parent ? AND name NOT IN ({placeholders})', added)
+        return self.conn.executemany(
+            self.get_update_query(doctype, fields),
+            [self.get_formatted_values(fields, doc) + [doc.name] for doc in docs]
+        )
+
+    def get_update_query(self, doctype, fields):
+        if len(fields) == len(self.get_keys(doctype)) - 1:
+            # every column but name, use the statement built with the meta
+            return self.app.get_meta(doctype).get_update_query()
+
+        assigns = ", ".join(map(lambda f: f'{f.fieldname} = ?', fields))
+        return f'UPDATE {doctype} SET {assigns} WHERE name = ?'
+
+    def delete_rows(self, doctype, names):
+        for chunk in self.chunk(names):
+            placeholders = ','.join(['?'] * len(chunk))
+            self.run(f'DELETE FROM {doctype} WHERE name IN ({placeholders})', chunk)
 
     def delete_one(self, doctype, name):
         return self.run(f'DELETE FROM {doctype} WHERE name = ?', [name])
@@ -187,35 +482,20 @@ class SQLiteDatabase(Database):
         base_doctype = meta.get_base_doctype()
         self.run(f'UPDATE {base_doctype} SET name = ? WHERE name = ?', (new_name, old_name))
         self.commit()
-
-    def set_values(self, doctype, name, field_value_pair):
-        meta = self.app.get_meta(doctype)
-        base_doctype = meta.get_base_doctype()
-        valid_fields = self.get_keys(doctype)
-        valid_fieldnames = tuple(map(lambda df: df.fieldname, valid_fields))
-        fields_to_update = list(filter(lambda df, vf=valid_fieldnames: df.fieldname in vf, field_value_pair.keys()))
-
-        # assignment part of query
-        assigns = ", ".join(map(lambda df: f'{df.fieldname} = ?'))
-
-        # values
-        values = [
-            self.get_formatted_value(
-                self.get_formatted_value(
-                    meta.get_field(fieldname),
-                    field_value_pair[fieldname]
-                )
-            )
-            for fieldname in fields_to_update
-        ]
-
-        # additional name for where clause
-        values.append(name)
-
-        return self.run(f'UPDATE {base_doctype} SET {assigns} WHERE name = ?', values)
+        super().rename(doctype, old_name, new_name)
 
     def sql(self, query, params=()):
         return self.conn.execute(query, params)
+
+    def sql_tuples(self, query, params=()):
+        # plain tuple rows, whatever `dictrows` is configured to
+        cursor = self.conn.cursor()
+        cursor.row_factory = None
+        return cursor.execute(query, params)
+
+    def in_transaction(self):
+        conn = self.conn
+        return bool(conn and conn.in_transaction)
         
     def init_type_map(self):
 
@@ -0,0 +1,243 @@
+import operator
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from iampy.utils.observable import ODict
+
+
+# Columnar view of a Table field: numeric child fields are copied once into
+# `array` columns and followed on `append` and on row assignments, aggregates run
+# over the arrays, through NumPy when it is installed
+#
+#   items = doc.get_table_columns('items')
+#   items.sum('amount')
+#   items.multiply_add('qty', 'rate')
+#   items.group_by('item_group', 'amount')
+#
+# empty values count as 0, like `get_sum`
+
+INT_FIELDTYPES = ('Int', 'Check')
+
+
+class KeyColumn(object):
+    # group keys, stored as codes into `keys`
+    __slots__ = ('codes', 'keys', 'index')
+
+    def __init__(self, values):
+        self.codes = array('q')
+        self.keys = []
+        self.index = {}
+        for value in values:
+            self.codes.append(self.get_code(value))
+
+    def get_code(self, value):
+        code = self.index.get(value)
+        if code is None:
+            code = self.index[value] = len(self.keys)
+            self.keys.append(value)
+        return code
+
+
+class TableColumns(object):
+    def __init__(self, doc, tablefield):
+        self.doc = doc
+        self.tablefield = tablefield
+        self.child_meta = None
+        self.rows = None
+        self.members = []
+        self.positions = {}
+        self.columns = {}
+        self.key_columns = {}
+
+    def get_child_meta(self):
+        if self.child_meta is None:
+            from iampy import app
+            self.child_meta = app.get_meta(self.doc.meta.get_field(self.tablefield).childtype)
+        return self.child_meta
+
+    def get_rows(self):
+        rows = self.doc[self.tablefield] or []
+        if rows is not self.rows or not self.same_rows(rows):
+            # replaced, or changed behind our back: rows assigned in place,
+            # reordered, inserted or removed
+            self.invalidate()
+            self.rows = rows
+            self.members = list(rows)
+            self.positions = {id(row): i for i, row in enumerate(rows)}
+        return rows
+
+    def same_rows(self, rows):
+        # the rows are held, so a removed row can not pass its id on to a new one
+        return len(rows) == len(self.members) and all(map(operator.is_, rows, self.members))
+
+    def invalidate(self):
+        self.rows = None
+        self.members = []
+        self.positions = {}
+        self.columns.clear()
+        self.key_columns.clear()
+
+    def get_typecode(self, fieldname):
+        field = self.get_child_meta().get_field(fieldname)
+        return 'q' if field and field.fieldtype in INT_FIELDTYPES else 'd'
+
+    def column(self, fieldname):
+        rows = self.get_rows()
+        values = self.columns.get(fieldname)
+        if values is None:
+            typecode = self.get_typecode(fieldname)
+            cast = int if typecode == 'q' else float
+            values = self.columns[fieldname] = array(
+                typecode, [cast(row[fieldname] or 0) for row in rows])
+        return values
+
+    def key_column(self, fieldname):
+        rows = self.get_rows()
+        keys = self.key_columns.get(fieldname)
+        if keys is None:
+            keys = self.key_columns[fieldname] = KeyColumn(row[fieldname] for row in rows)
+        return keys
+
+    def append(self, row):
+        # called by the document after the row joined the table
+        rows = self.doc[self.tablefield] or []
+        if rows is not self.rows or len(rows) != len(self.members) + 1 or rows[-1] is not row:
+            self.invalidate()
+            return
+
+        self.members.append(row)
+        self.positions[id(row)] = len(self.positions)
+        for fieldname, values in self.columns.items():
+            values.append(int(row[fieldname] or 0) if values.typecode == 'q' else float(row[fieldname] or 0))
+        for fieldname, keys in self.key_columns.items():
+            keys.codes.append(keys.get_code(row[fieldname]))
+
+    def update(self, row, fieldname):
+        # called by the document after `row[fieldname]` was assigned
+        values = self.columns.get(fieldname)
+        keys = self.key_columns.get(fieldname)
+        if values is None and keys is None:
+            return
+
+        i = self.positions.get(id(row))
+        if i is None:
+            self.invalidate()
+            return
+
+        if values is not None:
+            values[i] = int(row[fieldname] or 0) if values.typecode == 'q' else float(row[fieldname] or 0)
+        if keys is not None:
+            keys.codes[i] = keys.get_code(row[fieldname])
+
+    def __len__(self):
+        return len(self.get_rows())
+
+    def sum(self, fieldname):
+        values = self.column(fieldname)
+        if numpy is not None:
+            return as_number(as_ndarray(values).sum())
+        return sum(values)
+
+    def min(self, fieldname):
+        values = self.column(fieldname)
+        if not values:
+            return None
+        if numpy is not None:
+            return as_number(as_ndarray(values).min())
+        return min(values)
+
+    def max(self, fieldname):
+        values = self.column(fieldname)
+        if not values:
+            return None
+        if numpy is not None:
+            return as_number(as_ndarray(values).max())
+        return max(values)
+
+    def mean(self, fieldname):
+        values = self.column(fieldname)
+        if not values:
+            return None
+        if numpy is not None:
+            return float(as_ndarray(values).mean())
+        return sum(values) / len(values)
+
+    def multiply_add(self, fieldname, other):
+        # sum of the row products, eg. qty * rate over all rows
+        a = self.column(fieldname)
+        b = self.column(other)
+        if numpy is not None:
+            return as_number(numpy.dot(as_ndarray(a), as_ndarray(b)))
+        return sum(map(operator.mul, a, b))
+
+    def group_by(self, keyfield, fieldname = None, op = 'sum'):
+        # {key: aggregate of `fieldname`} in order of first appearance, `count`
+        # needs no fieldname
+        if op not in ('sum', 'count', 'min', 'max', 'mean'):
+            raise ValueError(f'Unsupported aggregate: {op}')
+
+        keys = self.key_column(keyfield)
+        values = self.column(fieldname) if op != 'count' else None
+        size = len(keys.keys)
+
+        if numpy is not None:
+            codes = as_ndarray(keys.codes)
+            counts = numpy.bincount(codes, minlength=size)
+            if op == 'count':
+                result = counts
+            elif op in ('sum', 'mean'):
+                result = numpy.bincount(codes, weights=as_ndarray(values), minlength=size)
+                if op == 'mean':
+                    result = result / numpy.maximum(counts, 1)
+                elif values.typecode == 'q':
+                    result = result.astype('int64')
+            else:
+                fill = numpy.inf if op == 'min' else -numpy.inf
+                result = numpy.full(size, fill)
+                getattr(numpy, 'minimum' if op == 'min' else 'maximum').at(result, codes, as_ndarray(values))
+                if values.typecode == 'q':
+                    result = numpy.where(counts > 0, result, 0).astype('int64')
+            counts = counts.tolist()
+            result = result.tolist()
+        else:
+            counts = [0] * size
+            for code in keys.codes:
+                counts[code] += 1
+            if op == 'count':
+                result = counts
+            else:
+                result = [None] * size
+                reduce = AGGREGATES[op]
+                for code, value in zip(keys.codes, values):
+                    current = result[code]
+                    result[code] = value if current is None else reduce(current, value)
+                if op == 'mean':
+                    result = [total / count if count else None for total, count in zip(result, counts)]
+
+        # keys left without rows by updates are dropped
+        return ODict(
+            (key, value)
+            for key, value, count in zip(keys.keys, result, counts)
+            if count
+        )
+
+
+AGGREGATES = {
+    'sum': operator.add,
+    'mean': operator.add,
+    'min': min,
+    'max': max
+}
+
+
+def as_ndarray(values):
+    # a view over the array's buffer, nothing is copied
+    return numpy.frombuffer(values, dtype='int64' if values.typecode == 'q' else 'float64')
+
+
+def as_number(value):
+    return value.item() if hasattr(value, 'item') else value
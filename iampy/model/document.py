@@ -2,9 +2,10 @@
 from iampy import app, errors
 
 from datetime import datetime
+from contextlib import contextmanager
 
 from . import naming
-from ..utils.observable import Observable, ODict
+from ..utils.observable import Observable, ODict, observable_state
 from ..utils.number_format import round
 from typing import Iterable
 
@@ -13,28 +14,136 @@ class BaseDocument(Observable):
     def __init__(self, data):
         super().__init__(data)
         self._flags = ODict()
+        self._dirty_fields = set()
+        self._table_columns = {}
         self.setup()
         self.update(data)
         self._dirty = False
+        self._dirty_fields = set()
 
     def setup(self):
         pass
 
     def update(self, data):
-        # First update non-child fields
-        for fieldname, value in data.items():
-            if isinstance(value, (list, dict)):
-                continue
-            self[fieldname] = value
-        
-        # Secondly only update child fields
-        for fieldname, value in data.items():
-            value = data[fieldname]
-            if isinstance(value, dict): # Form
-                self[fieldname] = self._init_child(value, fieldname)
-            elif isinstance(value, list): # Table and Tags
-                for child in value:
-                    self.append(fieldname, child)
+        with self.batch():
+            # First update non-child fields
+            for fieldname, value in data.items():
+                if isinstance(value, (list, dict)):
+                    continue
+                self[fieldname] = value
+            
+            # Secondly only update child fields
+            for fieldname, value in data.items():
+                value = data[fieldname]
+                if isinstance(value, dict): # Form
+                    self[fieldname] = self._init_child(value, fieldname)
+                elif isinstance(value, list): # Table and Tags
+                    rows = list(value)
+                    if self[fieldname] is value:
+                        # `data` is our own dict, as in __init__
+                        dict.__setitem__(self, fieldname, [])
+                    for child in rows:
+                        self.append(fieldname, child)
+
+    def set_values(self, values):
+        self.update(values)
+
+    @contextmanager
+    def batch(self):
+        # assignments inside fire no events, and skip validation and formulas,
+        # which run once on the way out, followed by a single `after_change`
+        # with `changes`, {fieldname: old value}; assignments to child rows are
+        # batched with their parent
+        if self._flags.in_batch:
+            yield self
+            return
+
+        if self.meta.is_child and self.parentdoc:
+            # the parent applies the batch, and recomputes what the row feeds
+            with self.parentdoc.batch():
+                yield self
+            return
+
+        self._flags.in_batch = True
+        self._flags.batch_changes = ODict()
+        self._flags.batch_rows = {}
+        try:
+            yield self
+            changes = self.apply_batch()
+        finally:
+            self._flags.in_batch = False
+            self._flags.batch_changes = None
+            self._flags.batch_rows = None
+
+        if changes:
+            self.trigger('after_change',
+                doc = self,
+                fieldname = None,
+                old_value = None,
+                new_value = None,
+                changes = changes
+            )
+
+    def get_batch_owner(self):
+        if self._flags.in_batch:
+            return self
+        if self.meta.is_child and self.parentdoc and self.parentdoc._flags.in_batch:
+            return self.parentdoc
+
+    def set_in_batch(self, owner, fieldname, value):
+        old = self[fieldname]
+        field = self.meta.get_field(fieldname)
+
+        dict.__setitem__(self, '_dirty', True)
+        self._dirty_fields.add(fieldname)
+
+        if field and field.fieldtype == 'Table':
+            self._table_columns.pop(fieldname, None)
+            dict.__setitem__(self, fieldname, [])
+            for i, row in enumerate(value or [], 1):
+                row.idx = i
+                self.append(fieldname, row, trigger=False)
+        else:
+            dict.__setitem__(self, fieldname, value)
+
+        if owner is self:
+            owner._flags.batch_changes.setdefault(fieldname, old)
+        else:
+            dict.__setitem__(owner, '_dirty', True)
+            owner.sync_table_columns(self.parentfield, self, fieldname)
+            owner._flags.batch_changes.setdefault(self.parentfield, None)
+            owner._flags.batch_rows.setdefault(id(self), (self, set()))[1].add(fieldname)
+
+    def apply_batch(self):
+        # fields assigned back their old value are not changes
+        changes = ODict(
+            (fieldname, old) for fieldname, old in self._flags.batch_changes.items()
+            if old is None or self[fieldname] != old
+        )
+        if not changes:
+            return changes
+
+        for fieldname in changes:
+            field = self.meta.get_field(fieldname)
+            if not field or field.fieldtype not in ('Table', 'Form'):
+                self.validate_field(fieldname, self[fieldname])
+        for row, fieldnames in list(self._flags.batch_rows.values()):
+            for fieldname in fieldnames:
+                row.validate_field(fieldname, row[fieldname])
+
+        # formulas read the rounded values, and round their own
+        self.round_floats(tuple(self._flags.batch_changes))
+        for row, fieldnames in list(self._flags.batch_rows.values()):
+            row.round_floats(tuple(fieldnames))
+
+        self.apply_formula()
+
+        # with the fields set by formulas
+        changes.update(
+            (fieldname, old) for fieldname, old in self._flags.batch_changes.items()
+            if fieldname not in changes and (old is None or self[fieldname] != old)
+        )
+        return changes
     
     @property
     def meta(self):
@@ -57,7 +166,13 @@ class BaseDocument(Observable):
             return
 
         if self[fieldname] != value:
+            owner = self.get_batch_owner()
+            if owner is not None:
+                self.set_in_batch(owner, fieldname, value)
+                return
+
             super().__setitem__('_dirty', True)
+            self._dirty_fields.add(fieldname)
             # if child is dirty, parent is dirty too
             if self.meta.is_child:
                 self.parentdoc._dirty = True
@@ -65,8 +180,9 @@ class BaseDocument(Observable):
             old = self[fieldname]
 
             if self.meta.get_field(fieldname).fieldtype == "Table":
+                self._table_columns.pop(fieldname, None)
                 super().__setitem__(fieldname, [])
-                for i, row in enumerate(value, 1):
+                for i, row in enumerate(value or [], 1):
                     row.idx = i
                     self.append(fieldname, row, trigger=False)
             else:
@@ -80,14 +196,25 @@ class BaseDocument(Observable):
 
             # always run apply_change from the parentdoc
             if self.meta.is_child and self.parentdoc:
-                self.parentdoc.apply_change(self.parentfield, old)
+                self.parentdoc.apply_change(self.parentfield, old, row=self, row_fieldname=fieldname)
             else:
                 self.apply_change(fieldname, old)
             
     
-    def apply_change(self, fieldname, old = None):
-        self.apply_formula(fieldname)
-        self.round_floats()
+    def apply_change(self, fieldname, old = None, row = None, row_fieldname = None):
+        if row is not None:
+            self.sync_table_columns(fieldname, row, row_fieldname)
+
+        # deferred ones are recomputed as a whole on commit, and values set by a
+        # formula are followed by the pass setting them
+        if not self._flags.defer_formulas and not self._flags.in_formula:
+            self.apply_formula(fieldname, row, row_fieldname)
+
+        if row is None:
+            self.round_floats((fieldname,))
+        else:
+            row.round_floats((row_fieldname,) if row_fieldname else None)
+
         self.trigger('after_change', 
             doc = self,
             fieldname = fieldname,
@@ -95,6 +222,14 @@ class BaseDocument(Observable):
             new_value = self[fieldname]
         )
 
+    def sync_table_columns(self, fieldname, row, row_fieldname = None):
+        view = self._table_columns.get(fieldname)
+        if view is not None:
+            if row_fieldname:
+                view.update(row, row_fieldname)
+            else:
+                view.append(row)
+
     def set_defaults(self):
         for field in self.meta.fields:
             if self[field.fieldname] is None:
@@ -106,7 +241,7 @@ class BaseDocument(Observable):
                     default = {}
                 if callable(field.default):
                     default = field.default(self)
-                else:
+                elif field.default is not None:
                     default = field.default
             
                 super().__setitem__(field.fieldname, default)
@@ -142,11 +277,18 @@ class BaseDocument(Observable):
             self[key].append(document)
             return
         
-        self[key].append(self._init_child(document, key))
+        row = self._init_child(document, key)
+        self[key].append(row)
         
         if trigger:
+            if self._flags.in_batch:
+                dict.__setitem__(self, '_dirty', True)
+                self._flags.batch_changes.setdefault(key, None)
+                self.sync_table_columns(key, row)
+                return
+
             self._dirty = True
-            self.apply_change(key)
+            self.apply_change(key, row=row)
 
     def _init_child(self, data, key):
         from iampy.utils import get_random_string
@@ -173,6 +315,30 @@ class BaseDocument(Observable):
 
         return BaseDocument(data)
 
+    def copy(self):
+        # cheap copy: rows are copied, field values are shared
+        doc = type(self).__new__(type(self))
+        dict.update(doc, self)
+        dict.update(doc, {
+            '_observable': observable_state(),
+            '_flags': ODict(self._flags or {}),
+            '_dirty_fields': set(self._dirty_fields or ()),
+            '_table_columns': {}
+        })
+
+        for field in self.meta.get_children_fields():
+            value = self[field.fieldname]
+            if isinstance(value, list):
+                value = [row.copy() if isinstance(row, BaseDocument) else ODict(row) for row in value]
+                for row in value:
+                    dict.__setitem__(row, 'parentdoc', doc)
+            elif isinstance(value, BaseDocument):
+                value = value.copy()
+                dict.__setitem__(value, 'parentdoc', doc)
+            dict.__setitem__(doc, field.fieldname, value)
+
+        return doc
+
     def get_errors(self):
         errors = ODict()
         self.validate_insert(errors, False)
@@ -270,9 +436,9 @@ class BaseDocument(Observable):
         for field in self.meta.get_valid_fields():
             value = self[field.fieldname]
             if field.fieldtype == "Form":
-                value = value.get_valid_dict()
+                value = value.get_valid_dict() if isinstance(value, BaseDocument) else value
             elif field.fieldtype == "Table":
-                value = list(map(lambda doc: doc.get_valid_dict() if hasattr(doc, 'get_valid_dict') else doc, value))
+                value = list(map(lambda doc: doc.get_valid_dict() if isinstance(doc, BaseDocument) else doc, value or []))
             data[field.fieldname] = value
         return data
 
@@ -306,7 +472,7 @@ class BaseDocument(Observable):
                 self.cast_values()
             self.load_links()
         else:
-            raise frappe.errors.NotFoundError(f'Not Found: {self.doctype}: {self.name}')
+            raise errors.NotFoundError(f'Not Found: {self.doctype}: {self.name}')
     
     def load_links(self):
         self._links = {}
@@ -325,12 +491,18 @@ class BaseDocument(Observable):
         return self._links.get(fieldname, None)
 
     def sync_values(self, data):
-        self.clear_values()
-        self.trigger('before_sync', doc=self)
-        self.update(data)
+        with self.batch():
+            self.clear_values()
+            self.trigger('before_sync', doc=self)
+            self.update(data)
         self._dirty = False
+        self._dirty_fields = set()
         self.trigger('after_sync', doc=self)
 
+    def get_dirty_fields(self):
+        # fieldnames assigned a new value since the last load or save
+        return set(self._dirty_fields or ())
+
     def clear_values(self):
         to_clear = ['_dirty'] + list(map(
             lambda df: df.fieldname,
@@ -339,97 +511,141 @@ class BaseDocument(Observable):
             self[key] = None
 
     def set_child_idx(self):
-        # renumber children
+        # renumber children, only rows whose position moved become dirty
         for field in self.meta.get_children_fields():
             if field.fieldtype == 'Table':
-                children = (self[field.fieldname] or [])[:]
-                self[field.fieldname] = []
-                for child in children:
+                children = self[field.fieldname] or []
+                for idx, child in enumerate(children, 1):
                     if not isinstance(child, BaseDocument):
-                        child = self._init_child(child, field.fieldname)
-                    self[field.fieldname].append(child)
+                        child = children[idx - 1] = self._init_child(child, field.fieldname)
+                    child.idx = idx
             elif field.fieldtype == 'Form':
-                child = self[field] or ODict()
+                child = self[field.fieldname] or ODict()
                 if not isinstance(child, BaseDocument):
                     child = self._init_child(child, field.fieldname)
-                self[field.fieldname] = child
+                    self[field.fieldname] = child
     
     def compare_with_current_doc(self):
         if app.is_server and not self.is_new():
-            current_doc = self.db.get(self.doctype, self.name)
+            # past the value cache, only the stored row tells of a conflict
+            modified = app.db.get_value(self.doctype, self.name, 'modified', cache=False)
+            if modified is None:
+                return
 
-            # Check for conflict
-            if current_doc and self.modified != current_doc.modified:
+            # Check for conflict, values are compared as they are stored
+            if modified != app.db.get_formatted_value(self.meta.get_field('modified'), self.modified):
                 raise errors.Conflict(
-                    app._('Document {0} {1} has been modified after loading', [
-                        self.doctype,
-                        self.name
-                    ])
+                    f'Document {self.doctype} {self.name} has been modified after loading'
                 )
             
+            if not self.meta.is_submittable:
+                return
+
             # set submit action flag
-            if self.submitted and not current_doc.submitted:
+            submitted = app.db.get_value(self.doctype, self.name, 'submitted', cache=False)
+            if self.submitted and not submitted:
                 self._flags.submit_action = True
 
-            if current_doc.submitted and not self.submitted:
+            if submitted and not self.submitted:
                 self._flags.revert_action = True
 
-    def apply_formula(self, fieldname=None):
+    @contextmanager
+    def defer_formulas(self):
+        # changes made inside only flag the formulas, `commit` recomputes them
+        deferred = self._flags.defer_formulas
+        self._flags.defer_formulas = True
+        try:
+            yield self
+        finally:
+            self._flags.defer_formulas = deferred
+
+    def apply_formula(self, fieldname = None, row = None, row_fieldname = None):
+        # without a fieldname every formula is recomputed, otherwise only the ones
+        # downstream of it, on the changed `row` when it comes from a child row
         if not self.meta.has_formula():
             return False
-        
-        doc = self
-        changed = False
-
-        def should_apply_formula(field, doc):
-            if field.read_only:
-                return True
-            if field.fieldname and field.formula_depends_on and field.fieldname in field.formula_depends_on:
-                return True
-            if not app.is_server:
-                if doc[field.fieldname] in (None, ''):
-                    return True
-            return False
 
-        # form children
-        for formfield in self.meta.get_formula_fields():
-            formula_fields = app.get_meta(formfield.childtype).get_formula_fields()
+        in_formula = self._flags.in_formula
+        self._flags.in_formula = True
+        try:
+            if fieldname is None:
+                return self.apply_all_formulas()
+            return self.apply_formula_from(fieldname, row, row_fieldname)
+        finally:
+            self._flags.in_formula = in_formula
 
-            if formula_fields:
-                row = self[formfield.fieldname] or {}
-                for field in formula_fields:
-                    if should_apply_formula(field, row):
-                        val = self.get_value_from_formula(field, row)
-                        previous_val = row[field.fieldname]
-                        if val is not None and previous_val != val:
-                            row[field.fieldname] = val
-                            changed = True
-
-        # table children
-        for tablefield in self.meta.get_table_fields():
-            formula_fields = app.get_meta(tablefield.childtype).get_formula_fields()
+    def apply_all_formulas(self):
+        changed = False
 
+        for childfield in self.meta.get_children_fields():
+            formula_fields = app.get_meta(childfield.childtype).get_formula_fields()
             if formula_fields:
-                # for each row
-                for row in (self[tablefield.fieldname] or []):
-                    for field in formula_fields:
-                        if should_apply_formula(field, row):
-                            val = self.get_value_from_formula(field, row)
-                            previous_val = row[field.fieldname]
-                            if val is not None and previous_val != val:
-                                row[field.fieldname] = val
-                                changed = True
+                for row in self.get_child_rows(childfield):
+                    changed = bool(self.apply_formula_fields(row, formula_fields)) or changed
 
         # parent or child row
-        for field in self.meta.get_formula_fields():
-            if should_apply_formula(field, doc):
-                previous_val = doc[field.fieldname]
+        return bool(self.apply_formula_fields(self, self.meta.get_formula_fields())) or changed
+
+    def apply_formula_from(self, fieldname, row = None, row_fieldname = None):
+        field = self.meta.get_field(fieldname)
+        changed = []
+
+        if row is not None:
+            # a single row changed, or was appended
+            formula_fields = row.meta.get_formula_fields(row_fieldname) if row_fieldname \
+                else row.meta.get_formula_fields()
+            changed += self.apply_formula_fields(row, formula_fields, row_fieldname)
+        elif field and field.fieldtype in ('Table', 'Form'):
+            # the whole table, or form, was replaced
+            formula_fields = app.get_meta(field.childtype).get_formula_fields()
+            for child in self.get_child_rows(field):
+                changed += self.apply_formula_fields(child, formula_fields)
+
+        parent_changed = self.apply_formula_fields(
+            self, self.meta.get_formula_fields(fieldname), fieldname)
+
+        # parent fields read by child formulas, which declare them
+        names = parent_changed if row is not None else [fieldname] + parent_changed
+        for childfield in self.meta.get_children_fields():
+            child_meta = app.get_meta(childfield.childtype)
+            for name in names:
+                formula_fields = child_meta.get_formula_fields(name)
+                if formula_fields:
+                    for child in self.get_child_rows(childfield):
+                        changed += self.apply_formula_fields(child, formula_fields, name)
+
+        return bool(changed or parent_changed)
+
+    def get_child_rows(self, childfield):
+        value = self[childfield.fieldname]
+        if childfield.fieldtype == 'Form':
+            return [value] if value else []
+        return value or []
+
+    def apply_formula_fields(self, doc, formula_fields, fieldname = None):
+        # sets the formula fields of `doc` in order, returns the ones which changed
+        changed = [fieldname] if fieldname else []
+        updated = []
+
+        for field in formula_fields:
+            if self.should_apply_formula(field, doc, changed):
                 val = self.get_value_from_formula(field, doc)
-                if val is not None and previous_val != val:
-                    doc[field.fieldname] = value
-                    changed = True
-        
-        return changed
+                if val is not None and doc[field.fieldname] != val:
+                    doc[field.fieldname] = val
+                    changed.append(field.fieldname)
+                    updated.append(field.fieldname)
+
+        return updated
+
+    def should_apply_formula(self, field, doc, changed = ()):
+        if field.read_only:
+            return True
+        if field.formula_depends_on and any(dep in changed for dep in field.formula_depends_on):
+            return True
+        if not app.is_server:
+            if doc[field.fieldname] in (None, ''):
+                return True
+        return False
 
     def get_value_from_formula(self, field, doc):
         value = None
@@ -446,8 +662,8 @@ class BaseDocument(Observable):
             value = self.round(value, field)
         
         if field.fieldtype == 'Form':
-            doc = self._init_child(doc, field.fieldname)
-            doc.round_floats()
+            value = self._init_child(value, field.fieldname)
+            value.round_floats()
         elif field.fieldtype == 'Table':
             def doc_round_floats(row):
                 doc = self._init_child(row, field.fieldname)
@@ -458,8 +674,11 @@ class BaseDocument(Observable):
         
         return value
     
-    def round_floats(self):
+    def round_floats(self, fieldnames = None):
+        # only `fieldnames` when given, the fields which just changed
         fields = filter(lambda df: df.fieldtype in ['Float', 'Currency', 'Table', 'Form'], self.meta.get_valid_fields())
+        if fieldnames is not None:
+            fields = filter(lambda df: df.fieldname in fieldnames, fields)
 
         for df in fields:
             value = self[df.fieldname]
@@ -469,7 +688,8 @@ class BaseDocument(Observable):
 
             if isinstance(value, list):
                 # child
-                map(lambda row: row.round_floats(), value)
+                for row in value:
+                    row.round_floats()
                 continue
             elif hasattr(value, 'round_floats'):
                 value.round_floats()
@@ -500,9 +720,11 @@ class BaseDocument(Observable):
         old_name = self.name
         data = app.db.insert(self.doctype, self.get_valid_dict())
         self.sync_values(data)
+        self._not_inserted = False
 
         if old_name != self.name:
             app.remove_from_cache(self.doctype, old_name)
+        app.add_to_cache(self)
 
         self.trigger('after_insert')
         self.trigger('after_save')
@@ -518,11 +740,14 @@ class BaseDocument(Observable):
         if self._flags.submit_action: self.trigger('before_submit')
         if self._flags.revert_action: self.trigger('before_rever')
 
-        # update modified by and modified
-        self.update_modified()
+        if self._dirty:
+            # update modified by and modified
+            self.update_modified()
 
-        data = self.db.update(self.doctype, self.get_valid_dict())
-        self.sync_values(data)
+            # only the columns assigned since load are written
+            data = app.db.update(self.doctype, self.get_valid_dict(), self.get_dirty_fields())
+            self.sync_values(data)
+            app.add_to_cache(self)
 
         self.trigger('after_update')
         self.trigger('after_save')
@@ -565,20 +790,26 @@ class BaseDocument(Observable):
             self[event](**params)
         super().trigger(event, **params)
 
+    def get_table_columns(self, tablefield):
+        # columnar view of a Table field, kept in sync with its rows
+        view = self._table_columns.get(tablefield)
+        if view is None:
+            from .columns import TableColumns
+            view = self._table_columns[tablefield] = TableColumns(self, tablefield)
+        return view
+
     def get_sum(self, tablefield, childfield):
-        return reduce(
-            lambda a, b: a + b, 
-            map(lambda d: float(d[childfield] or 0), self[tablefield] or []), 0)
+        return float(self.get_table_columns(tablefield).sum(childfield))
     
     def get_from(self, doctype, name, fieldname):
         if not name: return None
         return app.db.get_cached_value(doctype, name, fieldname)
     
-    def round(self, df = None):
-        if isinstance(df, string):
+    def round(self, value, df = None):
+        if isinstance(df, str):
             df = self.meta.get_field(df)
         
-        system_precision = app.SystemSettings.float_precision
+        system_precision = app.SystemSettings.float_precision if app.SystemSettings else None
         default_precision = system_precision if system_precision else 2
         precision = df.precision if df and df.precision is not None else default_precision
         return round(value, precision)
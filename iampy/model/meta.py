@@ -1,7 +1,153 @@
 
 from iampy import app, errors
+from types import MappingProxyType
 from .document import BaseDocument, ODict
 
+
+class FieldIndex(object):
+    # immutable lookups built once per meta, rebuilt when the DocType is re-saved
+    __slots__ = (
+        'fields', 'fieldtypes', 'valid_fields', 'valid_fields_with_children',
+        'columns', 'table_fields', 'form_fields', 'formula_fields', 'formula_graph',
+        'keyword_fields', 'insert_query', 'update_query'
+    )
+
+    def __init__(self, meta):
+        from iampy import model
+
+        type_map = app.db.type_map
+
+        # fields validation
+        for i, df in enumerate(meta.fields, 1):
+            if not df.fieldname:
+                raise errors.ValidationError(
+                    f'DocType {meta.name}: "fieldname" is required at index {i}'
+                )
+            
+            if not df.fieldtype:
+                raise errors.ValidationError(
+                    f'DocType {meta.name}: "fieldtype" is required for field {df.fieldname}'
+                )
+
+        doctype_fields = tuple(map(lambda df: df.fieldname, meta.fields))
+
+        standard_fields = list(model.common_fields)
+        if meta.is_submittable:
+            standard_fields.append(ODict(
+                fieldtype = 'Check',
+                fieldname = 'submitted',
+                label = 'Submitted',
+                default = 0
+            ))
+        standard_fields.extend(model.child_fields if meta.is_child else model.parent_fields)
+        if meta.is_tree:
+            standard_fields.extend(model.tree_fields)
+
+        field_map = {}
+        valid_fields = []
+        valid_fields_with_children = []
+
+        for field in standard_fields:
+            if field.fieldtype in type_map \
+                    and field.fieldname not in doctype_fields \
+                    and field.fieldname not in field_map:
+                field_map[field.fieldname] = field
+                valid_fields.append(field)
+                valid_fields_with_children.append(field)
+
+        fieldtypes = {}
+        for field in meta.fields:
+            field_map[field.fieldname] = field
+            fieldtypes.setdefault(field.fieldtype, []).append(field)
+
+            if field.fieldtype in type_map:
+                valid_fields.append(field)
+                valid_fields_with_children.append(field)
+            elif field.fieldtype in ('Table', 'Form'):
+                valid_fields_with_children.append(field)
+
+        keyword_fields = meta.keyword_fields
+        if not keyword_fields and meta.fields:
+            keyword_fields = map(lambda df: df.fieldname, 
+                filter(lambda df: df.fieldtype not in ('Form', 'Table') and df.required, meta.fields))
+        keyword_fields = tuple(keyword_fields or ()) or ('name',)
+
+        self.fields = MappingProxyType(field_map)
+        self.fieldtypes = MappingProxyType({k: tuple(v) for k, v in fieldtypes.items()})
+        self.valid_fields = tuple(valid_fields)
+        self.valid_fields_with_children = tuple(valid_fields_with_children)
+        self.columns = tuple(df.fieldname for df in valid_fields)
+        self.table_fields = self.fieldtypes.get('Table', ())
+        self.form_fields = self.fieldtypes.get('Form', ())
+        self.formula_fields = get_formula_order(meta.fields)
+        self.formula_graph = get_formula_graph(self.formula_fields, field_map)
+        self.keyword_fields = keyword_fields
+
+        table = meta.get_base_doctype()
+        placeholders = ','.join(['?'] * len(self.columns))
+        assigns = ', '.join(f'{column} = ?' for column in self.columns if column != 'name')
+        self.insert_query = f'INSERT INTO {table} ({",".join(self.columns)}) VALUES ({placeholders})'
+        self.update_query = f'UPDATE {table} SET {assigns} WHERE name = ?'
+
+
+def get_formula_order(fields):
+    # formula fields, each one after the formula fields it declares to depend on
+    formula_fields = {df.fieldname: df for df in fields if df.formula}
+    order = []
+    placed = set()
+    visiting = set()
+
+    def visit(df):
+        if df.fieldname in placed or df.fieldname in visiting:
+            # already placed, or a cycle: declaration order wins
+            return
+        visiting.add(df.fieldname)
+        for dep in df.formula_depends_on or ():
+            if dep in formula_fields:
+                visit(formula_fields[dep])
+        visiting.discard(df.fieldname)
+        placed.add(df.fieldname)
+        order.append(df)
+
+    for df in formula_fields.values():
+        visit(df)
+    return tuple(order)
+
+
+def get_formula_graph(formula_fields, field_map):
+    # fieldname -> formula fields to recompute when it changes, in evaluation order
+    #
+    # formulas without `formula_depends_on` depend on every field of their own doc,
+    # in child rows a parent field is only followed when declared
+    declared = {}
+    for df in formula_fields:
+        for dep in df.formula_depends_on or ():
+            declared.setdefault(dep, set()).add(df.fieldname)
+    opaque = set(df.fieldname for df in formula_fields if not df.formula_depends_on)
+
+    def direct(fieldname):
+        affected = set(declared.get(fieldname, ()))
+        if fieldname in field_map:
+            affected |= opaque
+        affected.discard(fieldname)
+        return affected
+
+    graph = {}
+    for fieldname in set(field_map) | set(declared):
+        affected = direct(fieldname)
+        pending = list(affected)
+        while pending:
+            for name in direct(pending.pop()):
+                if name not in affected and name != fieldname:
+                    affected.add(name)
+                    pending.append(name)
+
+        if affected:
+            graph[fieldname] = tuple(df for df in formula_fields if df.fieldname in affected)
+
+    return MappingProxyType(graph)
+
+
 class BaseMeta(BaseDocument):
     def __init__(self, data):
         if data.based_on:
@@ -48,57 +194,19 @@ class BaseMeta(BaseDocument):
             if df.fieldtype in ('Float', 'Currency'):
                 default_precision = app.SystemSettings.float_precision if app.SystemSettings else 2
                 df.precision = df.precision or default_precision
+
+        super().__setitem__('_index', FieldIndex(self))
         
     def has_field(self, fieldname):
         return bool(self.get_field(fieldname))
 
     def get_field(self, fieldname):
-        from iampy import model
-        if '_field_map' not in self:
-            super().__setitem__('_field_map', {})
-
-            # standard fields
-            for field in model.common_fields:
-                if field.fieldname not in self._field_map:
-                    self._field_map[field.fieldname] = field
-
-            # submit fields
-            if self.is_submittable:
-                if 'submitted' not in self._field_map:
-                    self._field_map['submitted'] = ODict(
-                        fieldtype = 'Check',
-                        fieldname = 'submitted',
-                        label=app._('Submitted'),
-                        default= 0
-                    )
-            
-            # child fields
-            if self.is_child:
-                for field in model.child_fields:
-                    if field.fieldtype in app.db.type_map \
-                            and field.fieldname not in self._field_map:
-                        self._field_map[field.fieldname] = field
-            else:
-                # parent field
-                for field in model.parent_fields:
-                    if field.fieldtype in app.db.type_map \
-                            and field.fieldname not in self._field_map:
-                        self._field_map[field.fieldname] = field 
-            
-            # tree fields
-            if self.is_tree:
-                for field in model.tree_fields:
-                    if field.fieldtype in app.db.type_map \
-                            and field.fieldname not in self._field_map:
-                        self._field_map[field.fieldname] = field
-
-            # doctype fields
-            for field in self.fields:
-                self._field_map[field.fieldname] = field
-        
-        return self._field_map.get(fieldname)
+        return self._index.fields.get(fieldname)
 
     def get_fields_with(self, filters):
+        if len(filters) == 1 and 'fieldtype' in filters:
+            return list(self._index.fieldtypes.get(filters['fieldtype'], ()))
+
         def fn(df):
             match = True
             for key, value in filters.items():
@@ -111,37 +219,34 @@ class BaseMeta(BaseDocument):
         return df.get_label() if df and hasattr(df, 'get_label') else df.label if df else None
     
     def get_table_fields(self):
-        if not self._table_fields:
-            self._table_fields = self.get_fields_with({'fieldtype': 'Table'})
-        return self._table_fields
+        return self._index.table_fields
 
     def get_form_fields(self):
-        if not self._form_fields:
-            self._form_fields = self.get_fields_with({'fieldtype': 'Form'})
-        return self._form_fields
+        return self._index.form_fields
 
     def get_children_fields(self):
         return self.get_table_fields() + self.get_form_fields()
 
-    def get_formula_fields(self):
-        if not hasattr(self, '_formula_fields'):
-            self._formula_fields = list(filter(lambda df: df.formula, self.fields))
-        return self._formula_fields
+    def get_formula_fields(self, fieldname = None):
+        if fieldname is None:
+            return self._index.formula_fields
+        return self._index.formula_graph.get(fieldname, ())
+
+    def get_columns(self):
+        return self._index.columns
+
+    def get_insert_query(self):
+        return self._index.insert_query
+
+    def get_update_query(self):
+        return self._index.update_query
 
     def has_formula(self):
-        if not hasattr(self, '_has_formula'):
-            self._has_formula = False
-        
-        if self.get_formula_fields():
-            self._has_formula = True
-        else:
-            for tablefield in self.get_table_fields():
-                if app.get_meta(tablefield.childtype).get_formula_fields():
-                    self._has_formula = True
-            
-            for formfield in self.get_form_fields():
-                if app.get_meta(form_field.childtype).get_formula_fields():
-                    self._has_formula = True
+        if self._has_formula is None:
+            self._has_formula = bool(self.get_formula_fields()) or any(
+                app.get_meta(df.childtype).get_formula_fields()
+                for df in self.get_children_fields()
+            )
 
         return self._has_formula
 
@@ -149,88 +254,13 @@ class BaseMeta(BaseDocument):
         return self.based_on or self.name
     
     def get_valid_fields(self, with_children=True):
-        from iampy import model
-        
-        if not self.get('_valid_fields'):
-            self._valid_fields = []
-            self._valid_fields_with_children = []
-
-            def _add(field, s = self):
-                s._valid_fields.append(field)
-                s._valid_fields_with_children.append(field)
-
-            # fields validation
-            for i, df in enumerate(self.fields, 1):
-                if not df.fieldname:
-                    raise errors.ValidationError(
-                        f'DocType {self.name}: "fieldname" is required at index {i}'
-                    )
-                
-                if not df.fieldtype:
-                    raise errors.ValidationError(
-                        f'DocType {self.name}: "fieldtype" is required for field {df.fieldname}'
-                    )
-            
-            doctype_fields = tuple(map(lambda df: df.fieldname, self.fields))
-
-            # standard fields
-            for field in model.common_fields:
-                if field.fieldtype in app.db.type_map \
-                    and field.fieldname not in doctype_fields:
-                    _add(field)
-            
-            if self.is_submittable:
-                _add(ODict(
-                    fieldtype = 'Check',
-                    fieldname = 'submitted',
-                    label = app._('Submitted')
-                ))
-
-            if self.is_child:
-                # child fields
-                for field in model.child_fields:
-                    if field.fieldtype in app.db.type_map \
-                        and field.fieldname not in doctype_fields:
-                        _add(field)
-            else:
-                # parent fields
-                for field in model.parent_fields:
-                    if field.fieldtype in app.db.type_map \
-                        and field.fieldname not in doctype_fields:
-                        _add(field)
-            
-            if self.is_tree:
-                # tree fields
-                for field in model.tree_fields:
-                    if field.fieldtype in app.db.type_map \
-                        and field.fieldname not in doctype_fields:
-                        _add(field)
-            
-            # doctype fields
-            for field in self.fields:
-                if field.fieldtype in app.db.type_map:
-                    _add(field)
-                
-                if field.fieldtype in ('Table', 'Form'):
-                    self._valid_fields_with_children.append(field)
-            
         if with_children:
-            return self._valid_fields_with_children
+            return self._index.valid_fields_with_children
         else:
-            return self._valid_fields
+            return self._index.valid_fields
 
     def get_keyword_fields(self):
-        if not self._keyword_fields:
-            self._keyword_fields = self.keyword_fields
-            print(self._keyword_fields)
-
-            if (not self._keyword_fields and self.fields):
-                self._keyword_fields = tuple(map(lambda df: df.fieldname, 
-                    filter(lambda df: df.fieldtype not in ('Form', 'Table') and df.required, self.fields)))
-            
-            if not self._keyword_fields:
-                self._keyword_fields = ('name',)
-        return self._keyword_fields
+        return self._index.keyword_fields
 
     def validate_select(self, field, value, error_dict, raise_errors):
         if not field.options:
@@ -0,0 +1,208 @@
+import os
+import sys
+import time
+import errno
+import random
+import signal
+import socket
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+
+# Pre-fork server: the master binds the socket once and forks `workers` processes
+# accepting on it, each one opens its own connections after the fork
+#
+#   SIGHUP          graceful restart, new workers are forked before the old ones stop
+#   SIGTERM/SIGINT  graceful shutdown, workers finish the request in hand
+#   SIGQUIT         immediate shutdown
+
+
+class WorkerWSGIServer(WSGIServer):
+    # a WSGIServer on an already listening, shared socket
+    def __init__(self, sock, wsgi_app, handler_class = WSGIRequestHandler):
+        host, port = sock.getsockname()[:2]
+        super().__init__((host, port), handler_class, bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+        self.set_app(wsgi_app)
+        self.requests = 0
+
+    def finish_request(self, request, client_address):
+        self.requests += 1
+        super().finish_request(request, client_address)
+
+
+class Worker(object):
+    def __init__(self, server, max_requests = 0):
+        self.server = server
+        self.max_requests = max_requests
+        self.alive = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGQUIT, signal.SIG_DFL)
+
+        # connections and caches inherited from the master are not ours to use
+        self.server.app.after_fork()
+
+        httpd = WorkerWSGIServer(self.server.socket, self.server.wsgi_app)
+        httpd.timeout = 1.0
+
+        while self.alive:
+            httpd.handle_request()
+            if self.max_requests and httpd.requests >= self.max_requests:
+                # recycled, the master forks a fresh worker in its place
+                break
+
+    def stop(self, signum = None, frame = None):
+        self.alive = False
+
+
+class PreforkServer(object):
+    def __init__(self,
+                app,
+                wsgi_app,
+                host = '127.0.0.1',
+                port = 8080,
+                workers = 2,
+                max_requests = 0,
+                max_requests_jitter = 0,
+                graceful_timeout = 30,
+                backlog = 2048):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self.socket = None
+        self.pids = set()
+        self.signals = []
+
+    def listen(self):
+        sock = socket.socket(socket.AF_INET6 if ':' in self.host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        # workers race on accept, the losers must not block
+        sock.setblocking(False)
+        return sock
+
+    def run(self):
+        self.socket = self.listen()
+
+        # the master only supervises, its own connections are not inherited
+        self.app.db.close()
+        self.app.db.after_fork()
+
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGQUIT):
+            signal.signal(signum, lambda signum, frame: self.signals.append(signum))
+
+        self.spawn_workers()
+        sys.stderr.write(f'iampy: listening on http://{self.host}:{self.port} with {self.workers} workers\n')
+
+        try:
+            while True:
+                signum = self.signals.pop(0) if self.signals else None
+                if signum == signal.SIGHUP:
+                    self.reload()
+                elif signum in (signal.SIGTERM, signal.SIGINT):
+                    self.stop(graceful=True)
+                    break
+                elif signum == signal.SIGQUIT:
+                    self.stop(graceful=False)
+                    break
+
+                self.reap()
+                self.spawn_workers()
+                time.sleep(0.2)
+        finally:
+            self.socket.close()
+
+    def spawn_workers(self):
+        while len(self.pids) < self.workers:
+            self.spawn_worker()
+
+    def spawn_worker(self):
+        # spread recycling so workers do not restart all at once
+        max_requests = self.max_requests
+        if max_requests and self.max_requests_jitter:
+            max_requests += random.randint(0, self.max_requests_jitter)
+
+        pid = os.fork()
+        if pid:
+            self.pids.add(pid)
+            return pid
+
+        code = 0
+        try:
+            Worker(self, max_requests).run()
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            code = 1
+        finally:
+            sys.stderr.flush()
+            os._exit(code)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            self.pids.discard(pid)
+
+    def reload(self):
+        # new workers take traffic before the old ones are asked to finish
+        old = set(self.pids)
+        self.pids.clear()
+        self.spawn_workers()
+        self.kill(old, signal.SIGTERM)
+
+    def stop(self, graceful = True):
+        pids = set(self.pids)
+        self.kill(pids, signal.SIGTERM if graceful else signal.SIGKILL)
+
+        deadline = time.monotonic() + self.graceful_timeout
+        while pids and time.monotonic() < deadline:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid:
+                pids.discard(pid)
+            else:
+                time.sleep(0.1)
+
+        self.kill(pids, signal.SIGKILL)
+        self.pids.clear()
+
+    def kill(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+
+def serve(wsgi_app, app = None, **kwargs):
+    from iampy import get_application
+
+    # the schema is migrated once, in the master, before any worker exists
+    app = app or get_application()
+
+    if kwargs.get('workers', 2) > 1:
+        app.db.enable_changes()
+
+    PreforkServer(app, wsgi_app, **kwargs).run()
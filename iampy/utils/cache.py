@@ -1,28 +1,254 @@
+import os
+import time
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+from .observable import ODict
 
-class CacheManager(object):
-    def __init__(self):
-        self.key_value_cache = {}
-        self.hash_cache = {}
 
-    def get(self, key):
-        self.key_value_cache.get(key)
+# tells a cached `None` apart from a miss
+MISSING = object()
+
+
+class LRUCache(object):
+    def __init__(self, max_size = 1000, ttl = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default = None):
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None:
+                value, expires = item
+                if expires is None or expires > time.monotonic():
+                    self.items.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.items[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl = None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else None
+
+        with self.lock:
+            self.items[key] = (value, expires)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            return self.items.pop(key, (None, None))[0]
+
+    def evict(self, fn):
+        # drop every key for which `fn(key)` is true
+        with self.lock:
+            for key in [key for key in self.items if fn(key)]:
+                del self.items[key]
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
 
-    def set(self, key, value):
-        self.key_value_cache[key] = value
+    def __len__(self):
+        return len(self.items)
 
-    def hget(self, hash, key):
-        return self.hash_cache.get(name, {}).get(key)
+    def stats(self):
+        total = self.hits + self.misses
+        return ODict(
+            hits = self.hits,
+            misses = self.misses,
+            evictions = self.evictions,
+            size = len(self.items),
+            hit_rate = self.hits / total if total else 0.0
+        )
 
-    def hset(self, hash, key, value):
-        if not hash in self.hash_cache:
-            self.hash_cache[hash] = {}
-        self.hash_cache[hash][key] = value
 
-    def hclear(self, hash, key=None):
-        if key:
-            self.hash_cache.get(hash, {}).pop(key, None)
+class DocumentCache(LRUCache):
+    # documents keyed by (doctype, name), a doctype ttl of 0 disables caching it
+    def __init__(self, max_size = 1000, ttl = None, doctype_ttl = None):
+        super().__init__(max_size, ttl)
+        self.doctype_ttl = doctype_ttl or {}
+
+    def set(self, key, value, ttl = None):
+        if ttl is None:
+            ttl = self.doctype_ttl.get(key[0])
+        if ttl == 0:
+            return
+        super().set(key, value, ttl)
+
+    def evict_doctype(self, doctype):
+        self.evict(lambda key: key[0] == doctype)
+
+
+class DiskStore(object):
+    # second tier in a sqlite file, shared by every worker process on the host,
+    # deletes leave a tombstone for `window` seconds so a `set` of a value read
+    # before the delete (`since`) is dropped instead of spreading to every worker
+    def __init__(self, path, timeout = 5, window = 60):
+        self.path = path
+        self.timeout = timeout
+        self.window = window
+        self.local = threading.local()
+
+    @property
+    def conn(self):
+        # connections are per thread, and never reused across a fork
+        if getattr(self.local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode = wal')
+            conn.execute('PRAGMA synchronous = normal')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'hash TEXT NOT NULL, key TEXT NOT NULL, value BLOB, expires REAL, '
+                'PRIMARY KEY (hash, key)) WITHOUT ROWID'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS evictions ('
+                'prefix TEXT PRIMARY KEY, at REAL NOT NULL) WITHOUT ROWID'
+            )
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+    def get(self, hash, key):
+        row = self.conn.execute(
+            'SELECT value, expires FROM cache WHERE hash = ? AND key = ?', (hash, str(key))
+        ).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return MISSING
+        return pickle.loads(row[0])
+
+    def set(self, hash, key, value, ttl = None, since = None):
+        params = (hash, str(key), pickle.dumps(value), time.time() + ttl if ttl else None)
+        if since is None:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO cache (hash, key, value, expires) VALUES (?, ?, ?, ?)', params
+            )
         else:
-            self.hash_cache[hash] = {}
+            self.conn.execute(
+                'INSERT OR REPLACE INTO cache (hash, key, value, expires) SELECT ?, ?, ?, ? '
+                'WHERE NOT EXISTS (SELECT 1 FROM evictions WHERE at >= ? '
+                'AND substr(?, 1, length(prefix)) = prefix)',
+                params + (since, hash)
+            )
+
+    def evicted(self, prefix):
+        # key deletes tombstone their whole hash, a reader only loses one fill
+        now = time.time()
+        self.conn.execute(
+            'INSERT OR REPLACE INTO evictions (prefix, at) VALUES (?, ?)', (prefix, now)
+        )
+        self.conn.execute('DELETE FROM evictions WHERE at < ?', (now - self.window,))
+
+    def delete(self, hash, key = None):
+        if key is None:
+            self.conn.execute('DELETE FROM cache WHERE hash = ?', (hash,))
+        else:
+            self.conn.execute('DELETE FROM cache WHERE hash = ? AND key = ?', (hash, str(key)))
+        self.evicted(hash)
+
+    def delete_prefix(self, prefix):
+        self.conn.execute('DELETE FROM cache WHERE substr(hash, 1, ?) = ?', (len(prefix), prefix))
+        self.evicted(prefix)
+
+    def exists(self, hash):
+        return self.conn.execute(
+            'SELECT 1 FROM cache WHERE hash = ? AND (expires IS NULL OR expires > ?) LIMIT 1',
+            (hash, time.time())
+        ).fetchone() is not None
+
+    def clear(self):
+        self.conn.execute('DELETE FROM cache')
+        self.evicted('')
+
+
+class CacheManager(object):
+    # plain keys live in the '' hash of the second tier
+    def __init__(self, max_size = 10000, ttl = None, store = None):
+        self.ttl = ttl
+        self.store = store
+        self.key_value_cache = LRUCache(max_size, ttl)
+        self.hash_cache = LRUCache(max_size, ttl)
+
+    def get(self, key, default = None):
+        value = self.key_value_cache.get(key, MISSING)
+        if value is MISSING and self.store:
+            value = self.store.get('', key)
+            if value is not MISSING:
+                self.key_value_cache.set(key, value)
+        return default if value is MISSING else value
+
+    def set(self, key, value, ttl = None):
+        self.key_value_cache.set(key, value, ttl)
+        if self.store:
+            self.store.set('', key, value, ttl or self.ttl)
+
+    def delete(self, key):
+        self.key_value_cache.delete(key)
+        if self.store:
+            self.store.delete('', key)
+
+    def hget(self, hash, key, default = None):
+        values = self.hash_cache.get(hash)
+        value = MISSING if values is None else values.get(key, MISSING)
+        if value is MISSING and self.store:
+            value = self.store.get(hash, key)
+            if value is not MISSING:
+                self.hset(hash, key, value, local = True)
+        return default if value is MISSING else value
+
+    def hset(self, hash, key, value, ttl = None, local = False, since = None):
+        with self.hash_cache.lock:
+            values = self.hash_cache.get(hash)
+            if values is None:
+                values = {}
+                self.hash_cache.set(hash, values, ttl)
+            values[key] = value
+
+        if self.store and not local:
+            self.store.set(hash, key, value, ttl or self.ttl, since = since)
+
+    def hclear(self, hash, key = None):
+        with self.hash_cache.lock:
+            if key is None:
+                self.hash_cache.delete(hash)
+            else:
+                (self.hash_cache.get(hash) or {}).pop(key, None)
+
+        if self.store:
+            self.store.delete(hash, key)
+
+    def hclear_prefix(self, prefix):
+        self.hash_cache.evict(lambda hash: hash.startswith(prefix))
+        if self.store:
+            self.store.delete_prefix(prefix)
 
     def hexists(self, hash):
-        return bool(self.hash_cache.get(hash))
\ No newline at end of file
+        if self.hash_cache.get(hash):
+            return True
+        return bool(self.store and self.store.exists(hash))
+
+    def clear(self, local = False):
+        self.key_value_cache.clear()
+        self.hash_cache.clear()
+        if self.store and not local:
+            self.store.clear()
+
+    def stats(self):
+        return ODict(
+            values = self.key_value_cache.stats(),
+            hashes = self.hash_cache.stats()
+        )
@@ -124,7 +124,7 @@ def round(num, precision):
     n = float("{:.8f}".format((abs(num) * m) if d else abs(num)))  # Avoid rounding errors
     i = math.floor(n)
     f = n - i
-    r = (i if i % 2 == 0 else i + 1) if not precision and f == 0.5 else math.round(n)
+    r = (i if i % 2 == 0 else i + 1) if not precision and f == 0.5 else math.floor(n + 0.5)
     r = r / m if d else r
     return - r if is_negative else r
     
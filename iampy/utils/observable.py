@@ -17,14 +17,17 @@ class ODict(dict):
         else:
             raise AttributeError(f'No such attribute: {name}')
 
+def observable_state():
+    return ODict(
+        is_hot = ODict(),
+        event_queue = ODict(),
+        listeners = ODict(),
+        once_listeners = ODict()
+    )
+
 class Observable(ODict):
     def __init__(self, *args, **kwargs):
-        kwargs['_observable'] = ODict(
-            is_hot = ODict(),
-            event_queue = ODict(),
-            listeners = ODict(),
-            once_listeners = ODict()
-        )
+        kwargs['_observable'] = observable_state()
 
         super().__init__(*args, **kwargs)
 
@@ -128,5 +131,5 @@ class Observable(ODict):
 
     def _trigger_event(self, type_, event, **params):
         if event in self._observable[type_]:
-            for listener in self._observable[_type][event]:
+            for listener in self._observable[type_][event]:
                 listener(**params)
\ No newline at end of file
@@ -0,0 +1,86 @@
+import json
+import decimal
+import datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BaseDocument = None
+
+
+# JSON encoding for responses, orjson when installed, json otherwise
+#
+# both encoders write dicts (ODict and sqlite rows included) natively, and call
+# `default` for the rest, documents are the exception: they are dicts holding
+# private state, so they become a plain dict of their columns first
+
+def default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        # as a string, a float would round it
+        return str(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+
+    # `Record` rows, and anything else offering a dict view
+    as_dict = getattr(type(obj), 'as_dict', None)
+    if as_dict is not None:
+        return as_dict(obj)
+
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def is_document(obj):
+    global BaseDocument
+    if BaseDocument is None:
+        # imported late, documents import the application
+        from iampy.model.document import BaseDocument
+    return isinstance(obj, BaseDocument)
+
+
+def prepare(obj):
+    if is_document(obj):
+        return document_to_dict(obj)
+    if isinstance(obj, list) and obj and is_document(obj[0]):
+        return [document_to_dict(doc) for doc in obj]
+    return obj
+
+
+def document_to_dict(doc):
+    # columns are read straight from the dict, values are not formatted or copied
+    meta = doc.meta
+    get = dict.get
+    data = {column: get(doc, column) for column in meta.get_columns()}
+
+    for field in meta.get_table_fields():
+        data[field.fieldname] = [
+            document_to_dict(row) if is_document(row) else row
+            for row in get(doc, field.fieldname) or ()
+        ]
+    for field in meta.get_form_fields():
+        value = get(doc, field.fieldname)
+        data[field.fieldname] = document_to_dict(value) if is_document(value) else value
+
+    return data
+
+
+if orjson is not None:
+    def dumps(obj):
+        return orjson.dumps(prepare(obj), default=default, option=orjson.OPT_NON_STR_KEYS)
+
+    def dump(obj, write):
+        write(dumps(obj))
+else:
+    # compact and UTF-8, like orjson
+    encoder = json.JSONEncoder(default=default, ensure_ascii=False, separators=(',', ':'))
+
+    def dumps(obj):
+        return encoder.encode(prepare(obj)).encode()
+
+    def dump(obj, write):
+        # chunks go to `write` as they are encoded, the whole body is never joined
+        for chunk in encoder.iterencode(prepare(obj)):
+            write(chunk.encode())
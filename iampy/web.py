@@ -11,6 +11,8 @@ sys.path.insert(0, os.path.join(
 
 from iampy import get_application
 from iampy.backends.sqlite import SQLiteDatabase, sqlite3
+from iampy.utils import serialize
+from iampy.api import run_batch, get_doc_etag, etag_matches, get_list_response, stream_list, ListStream
 from iampy.utils.observable import ODict
 from bottle import route, template, run, request, response, PluginError
 import json
@@ -57,14 +59,21 @@ class IAmPyPlugin(object):
             kwargs[self.keyword] = app
             request_writable = bottle.request.method in ('POST', 'PUT', 'DELETE')
 
+            streaming = False
+
+            if app.db.changes:
+                # Evict what sibling workers changed since the last request
+                app.db.changes.poll()
+
             try:
-                # Connect to the database
-                app.db.connect()
+                # Borrow a connection from the database pool, reads never wait for the writer
+                app.db.acquire(readonly=not request_writable)
                 if request_writable and app.config.db.autocommit:
                     # Start transaction when in Writable Mode
                     app.db.begin()
                 
                 rv = callback(*args, **kwargs)
+                streaming = inspect.isgenerator(rv)
                 
                 if request_writable and app.config.db.autocommit:
                     # Auto-commit when in Writable Mode
@@ -80,19 +89,47 @@ class IAmPyPlugin(object):
                     app.db.commit()
                 raise e
             finally:
-                # Close the database connection
-                app.db.close()
+                # Give the connection back to the pool, streams keep it until exhausted
+                if not streaming:
+                    app.db.release()
 
-            if getattr(callback, 'as_json', False):
+            if streaming:
+                return self.stream(rv, app)
+
+            if getattr(callback, 'as_json', False) and not isinstance(rv, bottle.HTTPResponse):
                 bottle.response.headers['Content-Type'] = 'application/json'
                 bottle.response.headers['Cache-Control'] = 'no-cache'
-                rv = json.dumps(rv)
+                rv = serialize.dumps(rv)
 
             return rv
 
         # Replace the route callback with the wrapped one.
         return wrapper
 
+    def stream(self, rv, app):
+        return StreamBody(rv, app.db.release)
+
+
+class StreamBody(object):
+    # the server calls `close` on the body even when it never iterated it, the
+    # borrowed connection is given back there, once
+    def __init__(self, body, release):
+        self.body = body
+        self.release = release
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        release, self.release = self.release, None
+        if release is None:
+            return
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            release()
+
 
 def rjson(fn):
     fn.as_json = True
@@ -106,27 +143,38 @@ def static_file(filename, app):
 @route('/api/resource/<doctype>')
 @rjson
 def get_list(doctype, app):
-    for key in ('fields', 'filters'):
-        if key in request.query and isinstance(request.query[key], str):
-            request.query[key] = json.loads(request.query[key])
-
-        return app.db.get_all(
-            doctype = doctype,
-            fields = request.query.fields,
-            filters = request.query.filters,
-            limit = request.query.limit or 20,
-            offset = request.query.offset or 0,
-            group_by = request.query.group_by or '',
-            order_by = request.query.order_by or 'creation',
-            order = request.query.order or 'asc'
-        )
-   
+    query = ODict(request.query.decode().items())
+
+    if query.stream in ('json', 'ndjson'):
+        stream = ListStream(query.stream)
+        response.headers['Content-Type'] = stream.content_type
+        response.headers['Cache-Control'] = 'no-cache'
+        return stream_list(app, doctype, query, stream)
+
+    rv = get_list_response(app, doctype, query, request.headers.get('If-None-Match'))
+    if rv.status == 304:
+        return bottle.HTTPResponse(status=304, headers=rv.headers)
+    return json_response(rv.body, rv.headers)
+
+
+def json_response(body, headers = None):
+    headers = dict(headers or {})
+    headers['Content-Type'] = 'application/json'
+    headers['Cache-Control'] = 'no-cache'
+    return bottle.HTTPResponse(body, headers=headers)
+
 
 @route('/api/resource/<doctype>/<name>')
 @rjson
 def get_doc(doctype, name, app):
+    etag = get_doc_etag(app, doctype, name)
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return bottle.HTTPResponse(status=304, headers={'ETag': etag})
+
     doc = app.get_doc(doctype, name)
-    return doc.get_valid_dict()
+    if etag:
+        response.headers['ETag'] = etag
+    return doc
 
 
 @route('/api/resource/<doctype>/<name>/<fieldname>')
@@ -143,7 +191,7 @@ def create(doctype, app):
     doc = app.new_doc(data)
 
     errors = doc.get_errors()
-    if not errors:
+    if errors:
         return {
             'status': -1,
             'msg': errors
@@ -159,7 +207,15 @@ def create(doctype, app):
 @route('/api/resource/<doctype>/search', 'POST')
 @rjson
 def search(doctype, app):
-    pass
+    data = json.loads(request.body.read() or '{}', object_pairs_hook=ODict)
+    return app.db.search(
+        doctype,
+        data.query or '',
+        fields = data.fields,
+        filters = data.filters,
+        limit = data.limit or 20,
+        offset = data.offset or 0
+    )
 
 @route('/api/resource/<doctype>/<name>', 'PUT')
 @rjson
@@ -168,7 +224,7 @@ def update(doctype, name, app):
     doc = app.get_doc(doctype, name)
     doc.update(data)
     doc.db_update()
-    return doc.get_valid_dict()
+    return doc
 
 
 @route('/api/resource/<doctype>/<name>', 'DELETE')
@@ -187,6 +243,23 @@ def delete_many(doctype, app):
     return {}
 
 
+@route('/api/method/<method>', 'POST')
+@rjson
+def call_method(method, app):
+    data = json.loads(request.body.read() or '{}', object_pairs_hook=ODict)
+    return app(method, *(data.args or ()), **(data.kwargs or {}))
+
+
+@route('/api/batch', 'POST')
+@rjson
+def batch(app):
+    # {"operations": [...], "atomic": false}, see `iampy.api.run_batch`
+    data = json.loads(request.body.read() or '{}', object_pairs_hook=ODict)
+    if isinstance(data, list):
+        data = ODict(operations = data)
+    return run_batch(app, data.operations or [], data.atomic)
+
+
 @route('/api/upload/<doctype>/<name>', 'POST')
 @rjson
 def upload_to_doc(doctype, name, app):
@@ -213,6 +286,30 @@ def index(app):
 
 
 if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='IAmPy web server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=1,
+        help='pre-fork this many worker processes sharing the socket')
+    parser.add_argument('--max-requests', type=int, default=0,
+        help='recycle a worker after this many requests, 0 never')
+    parser.add_argument('--max-requests-jitter', type=int, default=0)
+    args = parser.parse_args()
+
     app = bottle.default_app()
     app.install(IAmPyPlugin())
-    bottle.run(host='127.0.0.1', port=8080, debug=True)
\ No newline at end of file
+
+    if args.workers > 1:
+        from iampy.server import serve
+        serve(
+            app,
+            host = args.host,
+            port = args.port,
+            workers = args.workers,
+            max_requests = args.max_requests,
+            max_requests_jitter = args.max_requests_jitter
+        )
+    else:
+        bottle.run(host=args.host, port=args.port, debug=True)
\ No newline at end of file
@@ -0,0 +1,71 @@
+import pytest
+
+import iampy
+from iampy import Application
+from iampy.backends.sqlite import SQLiteDatabase
+from iampy.utils.observable import ODict
+
+
+def field(fieldname, fieldtype, **kwargs):
+    return ODict(fieldname = fieldname, fieldtype = fieldtype, **kwargs)
+
+
+MODELS = [
+    ODict(
+        name = 'Invoice',
+        keyword_fields = ['customer'],
+        fields = [
+            field('customer', 'Data'),
+            field('items', 'Table', childtype = 'InvoiceItem'),
+            field('total', 'Float', read_only = 1, formula_depends_on = ['items'],
+                formula = lambda doc: doc.get_sum('items', 'amount')),
+        ]
+    ),
+    ODict(
+        name = 'InvoiceItem',
+        is_child = 1,
+        fields = [
+            field('qty', 'Float'),
+            field('rate', 'Float'),
+            field('amount', 'Float', read_only = 1, formula_depends_on = ['qty', 'rate'],
+                formula = lambda row, doc: (row.qty or 0) * (row.rate or 0)),
+        ]
+    )
+]
+
+
+class TestApplication(Application):
+    # the models above on a fresh database, without the core doctypes
+    def __init__(self, file):
+        self.file = file
+        super().__init__()
+
+    def init_db(self):
+        from iampy.model import document, meta, naming
+
+        # modules bind the application when they are first imported
+        for module in (iampy, document, meta, naming):
+            module.app = self
+
+        self.config.db.file = self.file
+        self.config.db.pool = None
+        self.db = SQLiteDatabase(self)
+        self.db.on('change', self.on_db_change)
+        self.db.connect()
+        self.register_meta(MODELS)
+        for model in MODELS:
+            self.db.create_table(model.name)
+        self.db.commit()
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    from iampy.model import document, meta, naming
+
+    # restored after the test, the application rebinds them
+    for module in (iampy, document, meta, naming):
+        monkeypatch.setattr(module, 'app', None)
+
+    application = TestApplication(str(tmp_path / 'test.db'))
+    yield application
+    application.db.close()
@@ -0,0 +1,20 @@
+import asyncio
+
+from iampy.backends.aio import AsyncDatabase
+from iampy.utils.observable import ODict
+
+
+def test_coalesced_readers_get_their_own_child_rows(app):
+    app.db.bulk_insert('Invoice', [ODict(name = 'INV-1', customer = 'C1', items = [ODict(qty = 1, rate = 2)])])
+    db = AsyncDatabase(app.db, readers = 1)
+
+    async def read():
+        return await asyncio.gather(db.get_doc('Invoice', 'INV-1'), db.get_doc('Invoice', 'INV-1'))
+
+    try:
+        first, second = asyncio.run(read())
+    finally:
+        db.close()
+
+    first['items'][0]['qty'] = 10
+    assert second['items'][0]['qty'] == 1
@@ -0,0 +1,65 @@
+from iampy.api import get_doc_etag, get_list_response, run_batch, stream_list, ListStream
+from iampy.utils.observable import ODict
+
+
+def test_list_pages_with_the_fields_asked_for(app):
+    app.db.bulk_insert('Invoice', [ODict(customer = f'C{i}') for i in range(3)])
+    query = ODict(fields = '["customer"]', limit = '2', order_by = 'customer')
+
+    rv = get_list_response(app, 'Invoice', query)
+    assert rv.status == 200
+    assert rv.body == b'[{"customer":"C0"},{"customer":"C1"}]'
+
+    assert get_list_response(app, 'Invoice', query, rv.headers['ETag']).status == 304
+
+    rv = get_list_response(app, 'Invoice', ODict(query, after = rv.headers['X-Next-Cursor']))
+    assert rv.body == b'[{"customer":"C2"}]'
+
+
+def test_list_streams_rows_chunk_by_chunk(app):
+    app.db.bulk_insert('Invoice', [ODict(name = f'INV-{i}', customer = f'C{i}') for i in range(3)])
+
+    for fmt, body in (
+        ('json', b'[{"name":"INV-0","customer":"C0"},{"name":"INV-1","customer":"C1"},'
+            b'{"name":"INV-2","customer":"C2"}]'),
+        ('ndjson', b'{"name":"INV-0","customer":"C0"}\n{"name":"INV-1","customer":"C1"}\n'
+            b'{"name":"INV-2","customer":"C2"}\n')
+    ):
+        query = ODict(fields = '["customer"]', order_by = 'name', chunk_size = '2')
+        chunks = list(stream_list(app, 'Invoice', query, ListStream(fmt)))
+        assert b''.join(chunks) == body
+
+
+def test_doc_etag_moves_with_set_value(app):
+    app.db.bulk_insert('Invoice', [ODict(name = 'INV-1', customer = 'C1')])
+    etag = get_doc_etag(app, 'Invoice', 'INV-1')
+    assert etag and get_doc_etag(app, 'Invoice', 'INV-1') == etag
+
+    app.db.set_value('Invoice', 'INV-1', 'customer', 'C2')
+    app.db.commit()
+    assert get_doc_etag(app, 'Invoice', 'INV-1') != etag
+
+
+def test_atomic_batch_leaves_nothing_behind(app):
+    result = run_batch(app, [
+        ODict(op = 'create', doctype = 'Invoice', data = ODict(customer = 'C1')),
+        ODict(op = 'update', doctype = 'Invoice', name = 'missing', data = ODict(customer = 'C2')),
+        ODict(op = 'create', doctype = 'Invoice', data = ODict(customer = 'C3'))
+    ], atomic = True)
+
+    assert not result.committed
+    assert [row.status for row in result.results] == [200, 404, 424]
+    assert app.db.get_all('Invoice', fields = ['name']) == []
+
+
+def test_batch_undoes_a_failed_operation_alone(app):
+    result = run_batch(app, [
+        ODict(op = 'create', doctype = 'Invoice', data = ODict(customer = 'C1')),
+        ODict(op = 'update', doctype = 'Invoice', name = 'missing', data = ODict(customer = 'C2')),
+        ODict(op = 'create', doctype = 'Invoice', data = ODict(customer = 'C3'))
+    ])
+
+    assert result.committed
+    assert [row.status for row in result.results] == [200, 404, 200]
+    rows = app.db.get_all('Invoice', fields = ['customer'], order_by = 'customer', order = 'asc')
+    assert [row.customer for row in rows] == ['C1', 'C3']
@@ -0,0 +1,40 @@
+import asyncio
+
+from iampy.asgi import ASGIApplication
+from iampy.utils.observable import ODict
+
+
+def request(application, method, path, query = b'', body = b''):
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body}
+
+    async def send(message):
+        sent.append(message)
+
+    async def call():
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query, 'headers': []}
+        await application(scope, receive, send)
+
+    asyncio.run(call())
+    return sent[0]['status'], dict(sent[0]['headers']), b''.join(message.get('body', b'') for message in sent[1:])
+
+
+def test_list_streams_ndjson(app):
+    app.db.bulk_insert('Invoice', [ODict(name = f'INV-{i}', customer = f'C{i}') for i in range(3)])
+    application = ASGIApplication(app, readers = 1)
+
+    try:
+        status, headers, body = request(application, 'GET', '/api/resource/Invoice',
+            b'stream=ndjson&fields=["customer"]&order_by=name&chunk_size=2')
+    finally:
+        application.db.close()
+
+    assert status == 200
+    assert headers[b'content-type'] == b'application/x-ndjson'
+    assert body.splitlines() == [
+        b'{"name":"INV-0","customer":"C0"}',
+        b'{"name":"INV-1","customer":"C1"}',
+        b'{"name":"INV-2","customer":"C2"}'
+    ]
@@ -0,0 +1,186 @@
+import time
+import sqlite3
+import threading
+
+import pytest
+
+from iampy import errors
+from iampy.backends.changes import ChangeBus
+from iampy.utils.cache import DiskStore, MISSING
+from iampy.utils.observable import ODict
+
+
+def test_bulk_insert_fills_standard_fields(app):
+    count = app.db.bulk_insert('Invoice', [
+        ODict(customer = f'C{i}', items = [ODict(qty = i, rate = 2)])
+        for i in range(3)
+    ], batch_size = 2)
+
+    assert count == 3
+    rows = app.db.get_all('Invoice', fields = ['name', 'owner', 'creation', 'modified', 'total'],
+        order_by = 'customer', order = 'asc')
+    assert len(rows) == 3
+    assert all(row.name and row.owner and row.creation and row.modified for row in rows)
+    assert [row.total for row in rows] == [0, 2, 4]
+    assert len(app.db.get_all('InvoiceItem', fields = ['name'], order_by = 'name')) == 3
+
+
+def test_bulk_insert_leaves_caller_transaction_open(app):
+    app.db.begin()
+    app.db.bulk_insert('Invoice', [ODict(customer = 'C1')])
+    assert app.db.in_transaction()
+
+    app.db.rollback()
+    assert app.db.get_all('Invoice', fields = ['name']) == []
+
+
+def test_versions_move_after_commit(app):
+    version = app.db.get_version('Invoice')
+
+    app.db.begin()
+    app.db.bulk_insert('Invoice', [ODict(customer = 'C1')])
+    assert app.db.get_version('Invoice') == version
+    app.db.rollback()
+    assert app.db.get_version('Invoice') == version
+
+    app.db.begin()
+    app.db.bulk_insert('Invoice', [ODict(customer = 'C1')])
+    app.db.commit()
+    assert app.db.get_version('Invoice') == version + 1
+
+
+def test_rolled_back_savepoint_drops_its_changes(app):
+    version = app.db.get_version('Invoice')
+
+    app.db.savepoint('outer')
+    app.db.bulk_insert('Invoice', [ODict(customer = 'C1')])
+    app.db.savepoint('inner')
+    app.db.bulk_insert('Invoice', [ODict(customer = 'C2')])
+    app.db.rollback_to_savepoint('inner')
+    app.db.release_savepoint('outer')
+
+    assert app.db.get_version('Invoice') == version + 1
+
+
+def test_cached_value_is_not_filled_inside_a_transaction(app):
+    app.db.bulk_insert('Invoice', [ODict(name = 'INV-1', customer = 'C1')])
+
+    app.db.begin()
+    app.db.set_value('Invoice', 'INV-1', 'customer', 'C2')
+    assert app.db.get_cached_value('Invoice', 'INV-1', 'customer') == 'C2'
+    app.db.rollback()
+
+    assert app.db.get_cached_value('Invoice', 'INV-1', 'customer') == 'C1'
+
+
+def test_disk_store_drops_fills_read_before_an_eviction(tmp_path):
+    store = DiskStore(str(tmp_path / 'cache.db'))
+    since = time.time()
+    store.delete('Invoice:INV-1')
+
+    store.set('Invoice:INV-1', 'customer', 'C1', since = since)
+    assert store.get('Invoice:INV-1', 'customer') is MISSING
+
+    store.set('Invoice:INV-1', 'customer', 'C2', since = time.time())
+    assert store.get('Invoice:INV-1', 'customer') == 'C2'
+
+
+def test_poll_past_the_pruned_changes_evicts_everything(app):
+    app.db.enable_changes()
+    sibling = ChangeBus(app.db)
+    sibling.poll()
+
+    app.db.bulk_insert('Invoice', [ODict(name = 'INV-1', customer = 'C1')])
+    app.db.cache.hset('Invoice:INV-1', 'customer', 'stale')
+    version = app.db.get_version('InvoiceItem')
+
+    # the sibling slept through the retention window
+    app.db.changes.retention = -1
+    app.db.changes.prune()
+    app.db.commit()
+    sibling.poll()
+
+    assert app.db.get_cached_value('Invoice', 'INV-1', 'customer') == 'C1'
+    assert app.db.get_version('InvoiceItem') == version + 1
+    sibling.close()
+
+
+def test_release_restores_the_connected_connection(app):
+    app.config.db.pool = ODict(max_size = 2)
+    conn = app.db.conn
+
+    app.db.acquire(readonly = True)
+    assert app.db.conn is not conn
+    app.db.acquire()
+    app.db.release()
+    app.db.release()
+
+    assert app.db.conn is conn
+    assert app.db.get_all('Invoice', fields = ['name']) == []
+
+
+def test_get_all_without_fields_lists_keyword_fields(app):
+    app.db.bulk_insert('Invoice', [ODict(name = 'INV-1', customer = 'C1')])
+
+    for fields in (None, '', []):
+        rows = app.db.get_all('Invoice', fields = fields)
+        assert [row.name for row in rows] == ['INV-1']
+
+
+def test_enable_changes_without_a_connection(app):
+    # like the master of a pre-fork server, after init_db
+    app.db.close()
+    app.db.enable_changes()
+
+    app.db.connect()
+    app.db.bulk_insert('Invoice', [ODict(customer = 'C1')])
+    assert len(app.db.sql('SELECT id FROM _changes').fetchall()) == 1
+
+
+def test_pooled_reads_use_read_only_connections(app):
+    app.config.db.pool = ODict(max_size = 2)
+    app.db.bulk_insert('Invoice', [ODict(name = 'INV-1', customer = 'C1')])
+
+    app.db.acquire(readonly = True)
+    try:
+        assert [row.name for row in app.db.get_all('Invoice', fields = ['name'])] == ['INV-1']
+        with pytest.raises(sqlite3.OperationalError, match = 'readonly'):
+            app.db.sql('DELETE FROM Invoice')
+    finally:
+        app.db.release()
+
+
+def test_pooled_writes_go_through_a_single_writer(app):
+    app.config.db.pool = ODict(max_size = 2, timeout = 0.1)
+    outcome = []
+
+    def write():
+        try:
+            app.db.acquire()
+        except errors.DatabaseError:
+            outcome.append('timeout')
+            return
+        outcome.append(app.db.conn)
+        app.db.release()
+
+    app.db.acquire()
+    writer = app.db.conn
+    thread = threading.Thread(target = write)
+    thread.start()
+    thread.join()
+    app.db.release()
+
+    thread = threading.Thread(target = write)
+    thread.start()
+    thread.join()
+    assert outcome == ['timeout', writer]
+
+
+def test_iter_chunks_fetches_rows_chunk_by_chunk(app):
+    app.db.bulk_insert('Invoice', [ODict(name = f'INV-{i}', customer = f'C{i}') for i in range(5)])
+
+    chunks = list(app.db.iter_chunks('Invoice', fields = ['name'], order_by = 'name', order = 'asc', chunk_size = 2))
+    assert [[row.name for row in rows] for rows in chunks] == [['INV-0', 'INV-1'], ['INV-2', 'INV-3'], ['INV-4']]
+
+    rows = app.db.iter_all('Invoice', fields = ['name'], order_by = 'name', order = 'asc', limit = 3, chunk_size = 2)
+    assert [row.name for row in rows] == ['INV-0', 'INV-1', 'INV-2']
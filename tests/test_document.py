@@ -0,0 +1,149 @@
+import pytest
+
+from iampy import errors
+from iampy.utils.observable import ODict
+
+
+def new_invoice(app, rows):
+    doc = app.new_doc(ODict(doctype = 'Invoice', customer = 'C1'))
+    for qty, rate in rows:
+        doc.append('items', ODict(qty = qty, rate = rate))
+    return doc
+
+
+def test_row_update_recomputes_parent(app):
+    doc = new_invoice(app, [(1, 3), (2, 7)])
+    assert doc.total == 17
+
+    doc['items'][0].update({'qty': 10})
+
+    assert doc['items'][0].amount == 30
+    assert doc.total == 44
+    assert doc.get_sum('items', 'amount') == 44
+
+
+def test_batch_emits_one_change(app):
+    doc = new_invoice(app, [(1, 3), (2, 7)])
+    events = []
+    doc.on('after_change', lambda **kwargs: events.append(kwargs))
+
+    with doc.batch():
+        doc.customer = 'C2'
+        for row in doc['items']:
+            row.qty = 2
+
+    assert len(events) == 1
+    assert set(events[0]['changes']) == {'customer', 'items', 'total'}
+    assert doc.total == 20
+
+
+def test_update_round_trip(app):
+    doc = new_invoice(app, [(1, 3)])
+    doc.db_insert()
+    app.db.commit()
+
+    doc = app.get_doc('Invoice', doc.name)
+    doc.customer = 'C2'
+    doc['items'][0].qty = 4
+    doc.db_update()
+    app.db.commit()
+
+    stored = app.db.get_doc('Invoice', doc.name)
+    assert stored.customer == 'C2'
+    assert stored.total == 12
+    assert stored['items'][0].qty == 4
+
+
+def test_update_conflict(app):
+    doc = new_invoice(app, [(1, 3)])
+    doc.db_insert()
+    app.db.commit()
+
+    stale = app.get_doc('Invoice', doc.name)
+    fresh = app.get_doc('Invoice', doc.name)
+    fresh.customer = 'C2'
+    fresh.db_update()
+    app.db.commit()
+
+    stale.customer = 'C3'
+    with pytest.raises(errors.Conflict):
+        stale.db_update()
+
+
+def test_rolled_back_insert_is_not_cached(app):
+    app.db.begin()
+    doc = new_invoice(app, [(1, 3)])
+    doc.db_insert()
+    assert app.get_doc_from_cache('Invoice', doc.name) is None
+    app.db.rollback()
+
+    assert app.get_doc_from_cache('Invoice', doc.name) is None
+
+    doc = new_invoice(app, [(1, 3)])
+    doc.db_insert()
+    app.db.commit()
+    assert app.get_doc_from_cache('Invoice', doc.name).total == 3
+
+
+def test_table_columns_follow_rows_replaced_in_place(app):
+    doc = new_invoice(app, [(1, 3), (2, 7)])
+    items = doc.get_table_columns('items')
+    assert items.sum('amount') == 17
+
+    doc['items'][0] = ODict(qty = 5, rate = 5, amount = 25)
+    assert items.sum('amount') == 39
+
+    doc['items'].reverse()
+    assert list(items.column('amount')) == [14, 25]
+
+
+def test_changes_recompute_only_the_formulas_downstream(app):
+    calls = []
+
+    def formula(fieldname, fn):
+        def evaluate(doc):
+            calls.append(fieldname)
+            return fn(doc)
+        return ODict(fieldname = fieldname, fieldtype = 'Float', read_only = 1, formula = evaluate)
+
+    app.register_meta([ODict(name = 'Quote', fields = [
+        ODict(fieldname = 'a', fieldtype = 'Float'),
+        ODict(fieldname = 'b', fieldtype = 'Float'),
+        ODict(formula('double_a', lambda doc: (doc.a or 0) * 2), formula_depends_on = ['a']),
+        ODict(formula('triple_b', lambda doc: (doc.b or 0) * 3), formula_depends_on = ['b']),
+        ODict(formula('total', lambda doc: doc.double_a + doc.triple_b),
+            formula_depends_on = ['double_a', 'triple_b'])
+    ])])
+    doc = app.new_doc(ODict(doctype = 'Quote', a = 1, b = 1))
+    doc.commit()
+    assert doc.total == 5
+
+    del calls[:]
+    doc.a = 2
+    assert calls == ['double_a', 'total']
+    assert doc.total == 7
+
+    # deferred until the commit
+    del calls[:]
+    with doc.defer_formulas():
+        doc.b = 2
+        assert calls == []
+    doc.commit()
+    assert doc.total == 10
+
+
+def test_row_change_recomputes_only_that_row(app, monkeypatch):
+    doc = new_invoice(app, [(1, 3), (2, 7), (3, 1)])
+    field = app.get_meta('InvoiceItem').get_field('amount')
+    formula = field.formula
+    rows = []
+
+    def evaluate(row, doc):
+        rows.append(row)
+        return formula(row, doc)
+
+    monkeypatch.setitem(field, 'formula', evaluate)
+    doc['items'][1].qty = 4
+
+    assert len(rows) == 1 and rows[0] is doc['items'][1]
+    assert doc.total == 34
@@ -0,0 +1,30 @@
+def get_indexes(app, doctype):
+    return {index.name: list(index.fields) for index in app.db.get_table_indexes(doctype)}
+
+
+def test_reconcile_creates_standard_indexes_and_drops_stale_ones(app):
+    app.db.sql('CREATE INDEX idx_Invoice_customer ON Invoice (customer)')
+    app.db.sql('CREATE INDEX Invoice_by_customer ON Invoice (customer)')
+
+    app.db.indexes.reconcile('Invoice')
+    app.db.indexes.reconcile('InvoiceItem')
+
+    indexes = get_indexes(app, 'Invoice')
+    assert indexes['idx_Invoice_creation_name'] == ['creation', 'name']
+    assert indexes['idx_Invoice_modified_name'] == ['modified', 'name']
+    # only the manager's own indexes are dropped
+    assert 'idx_Invoice_customer' not in indexes
+    assert 'Invoice_by_customer' in indexes
+
+    assert get_indexes(app, 'InvoiceItem')['idx_InvoiceItem_parent_parentfield_idx'] == \
+        ['parent', 'parentfield', 'idx']
+
+
+def test_slow_queries_suggest_uncovered_indexes(app):
+    app.config.db.slow_query_time = 0
+    app.db.indexes.reconcile('Invoice')
+
+    app.db.get_all('Invoice', filters = {'customer': 'C1'})
+    app.db.get_all('Invoice', filters = {'creation': ['>', '2020-01-01']})
+
+    assert [suggestion.fields for suggestion in app.db.indexes.get_suggestions()] == [['customer', 'creation']]
@@ -0,0 +1,42 @@
+import pytest
+
+from iampy.utils.observable import ODict
+
+
+def find(app, text):
+    return [row.name for row in app.db.search('Invoice', text, fields = ['name'])]
+
+
+def test_search_index_follows_inserts_updates_and_deletes(app):
+    if not app.db.has_fts5():
+        pytest.skip('SQLite built without FTS5')
+    app.db.create_search_index('Invoice')
+    app.db.commit()
+
+    doc = app.new_doc(ODict(doctype = 'Invoice', customer = 'Acme Corp'))
+    doc.db_insert()
+    app.db.commit()
+    assert find(app, 'acme') == [doc.name]
+
+    doc.db_update(customer = 'Globex')
+    app.db.commit()
+    assert find(app, 'acme') == []
+    assert find(app, 'globex') == [doc.name]
+
+    doc.db_delete()
+    app.db.commit()
+    assert find(app, 'globex') == []
+
+
+def test_search_ranks_and_pages_matches(app):
+    if not app.db.has_fts5():
+        pytest.skip('SQLite built without FTS5')
+    app.db.create_search_index('Invoice')
+    app.db.bulk_insert('Invoice', [
+        ODict(name = 'INV-1', customer = 'Acme'),
+        ODict(name = 'INV-2', customer = 'Acme Acme Acme'),
+        ODict(name = 'INV-3', customer = 'Globex')
+    ])
+
+    assert find(app, 'acme') == ['INV-2', 'INV-1']
+    assert [row.name for row in app.db.search('Invoice', 'acme', fields = ['name'], limit = 1, offset = 1)] == ['INV-1']